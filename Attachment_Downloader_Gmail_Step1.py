@@ -1,31 +1,240 @@
 import imaplib
 import email
+import email.utils
 import sys
 import chardet
 import time
 import os
-import pickle
 import zipfile
 import hashlib
-from datetime import datetime
-from email.header import decode_header
+import binascii
+import tempfile
+import shutil
+import re
+import copy
+import concurrent.futures
+import queue
+import threading
+import select
+import socket
+import ssl
+from datetime import datetime, timedelta
+from email.header import decode_header, make_header
+from html.parser import HTMLParser
+from mailbox import mbox
 from bs4 import BeautifulSoup
 import requests
+from Mail_State_Store import MailStateStore
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class InvoiceLinkParser(HTMLParser):
+    """
+    Streaming scan for "Download Invoice(s)" links that gives the same result as the BeautifulSoup
+    search in MailBox._find_invoice_links_soup without building the whole document tree:
+    anchors whose .string mentions the phrase, or else the first anchor of each td[bgcolor="#ED2939"]
+    whose text does. Only the contents of anchors are kept.
+    """
+    PHRASE = 'download invoice'
+    VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.string_links = []  # hrefs of anchors whose .string contains the phrase
+        self.cell_links = []  # hrefs of the first anchor in a red table cell whose text contains the phrase
+        self.cells = []  # Open td elements: [is_red, anchor_seen]
+        self.anchor = None  # {'href', 'in_red_cell', 'root'} while inside <a>
+        self.nodes = []  # Open elements inside the current anchor
+
+    @classmethod
+    def scan(cls, body):
+        parser = cls()
+        parser.feed(body)
+        parser.close()
+        return parser.string_links or parser.cell_links
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'td':
+            self.cells.append([dict(attrs).get('bgcolor') == '#ED2939', False])
+        if self.anchor is not None:
+            node = {'tag': tag, 'children': []}
+            self.nodes[-1]['children'].append(node)
+            if tag not in self.VOID_TAGS:
+                self.nodes.append(node)
+        elif tag == 'a':
+            # Like cell.find('a'): only the first anchor inside each red cell counts
+            in_red_cell = False
+            for cell in self.cells:
+                if cell[0] and not cell[1]:
+                    in_red_cell = True
+                if cell[0]:
+                    cell[1] = True
+            root = {'tag': 'a', 'children': []}
+            self.anchor = {'href': dict(attrs).get('href'), 'in_red_cell': in_red_cell, 'root': root}
+            self.nodes = [root]
+
+    def handle_startendtag(self, tag, attrs):
+        if self.anchor is not None:
+            self.nodes[-1]['children'].append({'tag': tag, 'children': []})
+        elif tag == 'a':
+            self.handle_starttag(tag, attrs)
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if self.anchor is not None:
+            if tag == 'a':
+                self._finish_anchor()
+            else:
+                # Close the matching element, tolerating unclosed inner tags
+                for depth in range(len(self.nodes) - 1, 0, -1):
+                    if self.nodes[depth]['tag'] == tag:
+                        del self.nodes[depth:]
+                        break
+        if tag == 'td' and self.cells:
+            self.cells.pop()
+
+    def handle_data(self, data):
+        if self.anchor is not None:
+            self.nodes[-1]['children'].append(data)
+
+    def handle_comment(self, data):
+        # Comments count as children for .string but contribute no text
+        if self.anchor is not None:
+            self.nodes[-1]['children'].append({'tag': '!--', 'children': []})
+
+    def close(self):
+        super().close()
+        if self.anchor is not None:
+            self._finish_anchor()
+
+    def _finish_anchor(self):
+        anchor, self.anchor, self.nodes = self.anchor, None, []
+        string = self._single_string(anchor['root'])
+        if string is not None and self.PHRASE in string.lower():
+            self.string_links.append(anchor['href'])
+        if anchor['in_red_cell'] and self.PHRASE in self._text(anchor['root']).lower():
+            self.cell_links.append(anchor['href'])
+
+    def _single_string(self, node):
+        # BeautifulSoup's .string: follow single children down to a lone text node
+        while len(node['children']) == 1:
+            child = node['children'][0]
+            if isinstance(child, str):
+                return child
+            node = child
+        return None
+
+    def _text(self, node):
+        return ''.join(child if isinstance(child, str) else self._text(child) for child in node['children'])
+
+
+class MailArchive:
+    """
+    Local source of messages for replaying old carrier mail: an mbox file or a directory of .eml files.
+    Stands in for an IMAP connection in MailBox's pipeline, keyed by file name or mbox position.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mbox = mbox(path, create=False) if os.path.isfile(path) else None
+        self.fetched_bytes = 0
+
+    def message_ids(self):
+        """Keys of every message in archive order"""
+        if self.mbox is not None:
+            return list(self.mbox.keys())
+        return sorted(name for name in os.listdir(self.path) if name.lower().endswith('.eml'))
+
+    def fetch_messages(self, message_ids):
+        """Yield (message id, parsed message) pairs, like MailBox.fetch_messages"""
+        for message_id in message_ids:
+            if self.mbox is not None:
+                raw = self.mbox.get_bytes(message_id)
+            else:
+                with open(os.path.join(self.path, message_id), 'rb') as f:
+                    raw = f.read()
+            self.fetched_bytes += len(raw)
+            yield message_id, email.message_from_bytes(raw)
 
 
 class MailBox:
     SMTP_SERVER = 'imap.gmail.com'
     SMTP_PORT = 993
+    USE_SSL = True  # Set to False to talk plain IMAP to a local server
     USER = '*********'     # Replace with your email
     PASSWORD = '*********'  # Replace with your password
+    STATE_DB_FILE = 'mailbox_state.sqlite3'  # Processed messages, downloaded file hashes and UID sync state
+    # Old pickle state files, imported into STATE_DB_FILE once
     PROCESSED_IDS_FILE = 'processed_emails.pickle'
-    DOWNLOADED_FILES_FILE = 'downloaded_files.pickle'  # New file to track downloaded attachments
+    DOWNLOADED_FILES_FILE = 'downloaded_files.pickle'
+    SYNC_STATE_FILE = 'sync_state.pickle'
+    USE_UID_SYNC = True  # Only ask the server for UIDs above the last synced one
+    # Server-side SEARCH criteria, so the server only returns candidate messages
+    SEARCH_SINCE = None  # Never look at mail that arrived before this date, e.g. datetime(2024, 1, 1)
+    SEARCH_FROM = ()  # Only mail from these senders or domains, e.g. ('bluedart.com', 'delhivery.com')
+    SEARCH_UNKEYWORD = ()  # Skip mail carrying these IMAP keywords
+    USE_SYNC_DATE_WATERMARK = True  # Search SINCE the last fully successful sync when there is no UID watermark
+    SYNC_DATE_OVERLAP_DAYS = 1  # SINCE has day granularity in the server's timezone, so re-check the previous day
+    FETCH_BATCH_SIZE = 50  # Messages requested per FETCH command
+    USE_PARTIAL_FETCH = True  # Fetch BODYSTRUCTURE first, then only the MIME sections we use
+    CLASSIFY_HEADERS = True  # Route emails from a few header fields before fetching any body
+    CLASSIFY_BATCH_SIZE = 500  # Messages per header FETCH while classifying
+    # (route, header, regex) rules tried in order, the first match wins. Routes: 'attachments' (BlueDart files only),
+    # 'links' (Delhivery invoice links only), 'all' (both) and 'skip' (recorded as processed without fetching),
+    # e.g. ('attachments', 'from', r'@bluedart\.com'), ('links', 'from', r'@delhivery\.com')
+    CLASSIFICATION_RULES = (
+        # Single-part plain text has neither attachments nor HTML, unless the body is itself an attached file
+        ('skip', 'content-type', r'^\s*text/plain'),
+    )
+    DEFAULT_ROUTE = 'all'
+    ATTACHMENT_EXTENSIONS = None  # e.g. ('.csv', '.zip', '.xlsx', '.xls', '.pdf') to fetch only those attachments in partial mode
+    STREAM_CHUNK_SIZE = 1024 * 1024  # Bytes per chunk when streaming downloads to disk
+    ZIP_WORKERS = 4  # ZIP members decompressed concurrently (zlib releases the GIL)
+    MAX_ZIP_DEPTH = 3  # Levels of nested ZIPs that are extracted
+    CHARSET_SAMPLE_BYTES = 32 * 1024  # Bytes of a body passed to chardet when its charset is unknown
+    FAST_LINK_SCAN = True  # Keyword pre-filter and streaming link scan instead of a full BeautifulSoup parse
+    USE_CONTENT_STORE = True  # Keep each file once in downloads/.store and hard-link it into the carrier folders
+    POOL_SIZE = 1  # Number of IMAP connections used to download in parallel
+    USE_PIPELINE = True  # Overlap fetching, parsing and writing in separate stages
+    PIPELINE_QUEUE_SIZE = 100  # Max messages waiting between two pipeline stages
+    PIPELINE_PARSE_WORKERS = 2  # Threads decoding and scanning email bodies
+    PIPELINE_REPORT_INTERVAL = 10  # Seconds between queue depth reports while fetching
+    IDLE_TIMEOUT = 25 * 60  # Re-issue IDLE before servers drop it at 29 minutes (RFC 2177)
+    WATCH_POLL_INTERVAL = 60  # Seconds between checks when the server doesn't support IDLE
+    WATCH_RECONNECT_DELAY = 5  # Initial seconds to wait before reconnecting, doubled on each failure
+    WATCH_MAX_RECONNECT_DELAY = 300
+    LINK_DOWNLOAD_WORKERS = 4  # Concurrent Delhivery invoice link downloads
+    LINK_TIMEOUT = (10, 120)  # (connect, read) timeout in seconds per link request
+    LINK_RETRIES = 3  # Retries per link on connection errors and 429/5xx responses
+    LINK_BACKOFF = 1.0  # Backoff factor between retries (1s, 2s, 4s, ...)
+    USE_LINK_CACHE = True  # Remember each link's ETag/Last-Modified and content hash, and resume partial downloads
+    LINK_REVALIDATE = False  # Re-check already downloaded links with a conditional GET instead of skipping them
+    # Several machines can share the folder by claiming messages with IMAP keywords (needs UID sync)
+    USE_KEYWORD_CLAIMS = False
+    CLAIMED_KEYWORD = '$TNBTClaimed'  # Set while a machine is working on a message
+    DONE_KEYWORD = '$TNBTDone'  # Set once a message is processed; searches skip these
 
-    def __init__(self):
+    def __init__(self, connect=True):
+        """connect=False skips the IMAP login, for replaying local archives with replay()"""
         try:
-            self.imap = imaplib.IMAP4_SSL(host=self.SMTP_SERVER, port=self.SMTP_PORT)
-            self.imap.login(self.USER, self.PASSWORD)
-            print("Successfully logged in")
+            self.imap = None
+            self.folder = None
+            self.uidvalidity = None
+            if connect:
+                self.imap = self._connect()
+                print("Successfully logged in")
+            self._state_lock = threading.RLock()  # Guards dedup state and file writes shared by pool workers
+            self.http = self._create_http_session()
+            self.link_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.LINK_DOWNLOAD_WORKERS)
+            self.link_stats = {'downloaded': 0, 'bytes': 0, 'cached': 0, 'failed': []}
+            self._link_futures = {}  # Link downloads queued this run, by href
+            self._done_uids = []  # Processed UIDs still to be marked DONE_KEYWORD on the server
+            self.zip_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.ZIP_WORKERS)
+            self._dir_index = {}  # Per-directory filename index used for collision checks
+            self.sender_charsets = {}  # Charset chardet detected for each sender's bodies
+            self.pipeline_queues = {}
+            self.routes = {}  # Route of each pending email from header classification
             
             # Create main downloads directory
             self.download_dir = "downloads"
@@ -35,110 +244,433 @@ class MailBox:
             # Create separate folders for Delhivery and BlueDart
             self.delhivery_dir = os.path.join(self.download_dir, "delhivery")
             self.bluedart_dir = os.path.join(self.download_dir, "bluedart")
+            self.store_dir = os.path.join(self.download_dir, ".store")
+            self.partial_dir = os.path.join(self.download_dir, ".partial")  # Interrupted link downloads kept for resuming
             
-            for directory in [self.delhivery_dir, self.bluedart_dir]:
+            for directory in [self.delhivery_dir, self.bluedart_dir, self.store_dir, self.partial_dir]:
                 if not os.path.exists(directory):
                     os.makedirs(directory)
             
             # Load processed email IDs and downloaded files
-            self.processed_ids = self._load_processed_ids()
-            self.downloaded_files = self._load_downloaded_files()
+            self.state = MailStateStore(self.STATE_DB_FILE)
+            self.state.migrate_pickles(self.PROCESSED_IDS_FILE, self.DOWNLOADED_FILES_FILE, self.SYNC_STATE_FILE)
+            self.processed_ids = self.state.processed_ids
+            self.downloaded_files = self.state.downloaded_files
+            self.sync_state = self.state.sync_state
+            self.link_cache = self.state.link_cache
+            self.fetched_bytes = 0
             print(f"Loaded {len(self.processed_ids)} previously processed email IDs")
             print(f"Loaded {len(self.downloaded_files)} previously downloaded files")
                 
             # Select the Automation folder
-            self.select_folder("Automation")
+            if connect:
+                self.select_folder("Automation")
             
         except imaplib.IMAP4.error as e:
             print(f"Login failed: {e}")
             sys.exit(1)
 
-    def _load_processed_ids(self):
-        """Load the set of processed email IDs"""
-        try:
-            with open(self.PROCESSED_IDS_FILE, 'rb') as f:
-                return pickle.load(f)
-        except (FileNotFoundError, EOFError):
-            return set()  # Return empty set if file doesn't exist
-
-    def _save_processed_ids(self):
-        """Save processed email IDs to pickle file"""
-        with open(self.PROCESSED_IDS_FILE, 'wb') as f:
-            pickle.dump(self.processed_ids, f)
-        print(f"Saved {len(self.processed_ids)} processed email IDs")
+    def _connect(self):
+        """Open and authenticate a new IMAP connection"""
+        if self.USE_SSL:
+            imap = imaplib.IMAP4_SSL(host=self.SMTP_SERVER, port=self.SMTP_PORT)
+        else:
+            imap = imaplib.IMAP4(host=self.SMTP_SERVER, port=self.SMTP_PORT)
+        imap.login(self.USER, self.PASSWORD)
+        # imaplib keeps the pre-login capabilities; Gmail only lists extensions such as CONDSTORE after login
+        _, data = imap.capability()
+        if data and data[-1]:
+            imap.capabilities = tuple(data[-1].decode().upper().split())
+        return imap
 
-    def _load_downloaded_files(self):
-        """Load the dictionary of downloaded files and their hashes"""
-        try:
-            with open(self.DOWNLOADED_FILES_FILE, 'rb') as f:
-                return pickle.load(f)
-        except (FileNotFoundError, EOFError):
-            return {}  # Return empty dict if file doesn't exist
-
-    def _save_downloaded_files(self):
-        """Save downloaded files dictionary to pickle file"""
-        with open(self.DOWNLOADED_FILES_FILE, 'wb') as f:
-            pickle.dump(self.downloaded_files, f)
+    def save_state(self):
+        """Commit any outstanding processed IDs, downloaded file hashes and UID sync state"""
+        self.state.commit()
+        print(f"Saved {len(self.processed_ids)} processed email IDs")
         print(f"Saved {len(self.downloaded_files)} downloaded file records")
+        for folder, state in self.sync_state.items():
+            print(f"Saved sync state for {folder}: last UID {state['last_uid']} (UIDVALIDITY {state['uidvalidity']}), "
+                  f"last full sync {state['last_sync_date'] or 'never'}")
 
     def _calculate_file_hash(self, content):
         """Calculate SHA-256 hash of file content"""
         return hashlib.sha256(content).hexdigest()
 
-    def _handle_duplicate_file(self, directory, filename, content):
+    def _calculate_path_hash(self, path):
+        """Calculate SHA-256 hash of a file on disk, reading it in chunks"""
+        hasher = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.STREAM_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def _stream_to_temp_file(self, directory, chunks):
+        """
+        Write an iterable of byte chunks to a temp file in directory, hashing as it goes.
+        Returns (temp_path, content_hash, size).
+        """
+        hasher = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.download-', suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    if chunk:
+                        hasher.update(chunk)
+                        f.write(chunk)
+                        size += len(chunk)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return temp_path, hasher.hexdigest(), size
+
+    def _commit_temp_file(self, directory, filename, temp_path, content_hash):
+        """
+        Atomically rename a streamed temp file to a unique name in directory.
+        Returns the final filename, or None (and removes the temp file) if an identical file already exists.
+        """
+        size = os.path.getsize(temp_path)
+        final_name, is_duplicate = self._handle_duplicate_file(directory, filename, content_hash=content_hash, size=size)
+        if is_duplicate:
+            os.remove(temp_path)
+            return None
+        final_path = os.path.join(directory, final_name)
+        if self.USE_CONTENT_STORE:
+            self._materialize(self._store_blob(temp_path, content_hash), final_path)
+        else:
+            os.replace(temp_path, final_path)
+        self._index_add(directory, final_name, size, content_hash)
+        return final_name
+
+    def _blob_path(self, content_hash):
+        """Path of a content hash in the store, e.g. downloads/.store/ab/cdef..."""
+        return os.path.join(self.store_dir, content_hash[:2], content_hash[2:])
+
+    def _store_blob(self, temp_path, content_hash):
+        """Move a streamed temp file into the content-addressed store, or drop it if the blob already exists"""
+        blob_path = self._blob_path(content_hash)
+        if os.path.exists(blob_path):
+            os.remove(temp_path)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(temp_path, blob_path)
+        return blob_path
+
+    def _materialize(self, blob_path, target_path):
+        """Populate target_path from a stored blob: hard link, else symlink, else a plain copy"""
+        try:
+            os.link(blob_path, target_path)
+            return
+        except OSError:
+            pass  # Different volume or a filesystem without hard links
+        try:
+            os.symlink(os.path.abspath(blob_path), target_path)
+            return
+        except (OSError, NotImplementedError):
+            pass  # e.g. Windows without the symlink privilege
+        shutil.copyfile(blob_path, target_path)
+
+    def _iter_part_payload(self, part):
+        """Yield the decoded payload of a MIME part in chunks, decoding base64 incrementally"""
+        if (part.get('Content-Transfer-Encoding') or '').strip().lower() != 'base64':
+            yield part.get_payload(decode=True) or b''
+            return
+
+        encoded = part.get_payload()
+        if sum(len(chunk) for chunk in self._base64_chunks(encoded)) % 4 == 1:
+            # Truncated mid-group, which a2b_base64 rejects; decoded chunks can't be taken back once
+            # yielded, so check first and leave the whole part to email's own decoder
+            yield part.get_payload(decode=True) or b''
+            return
+
+        pending = ''
+        for chunk in self._base64_chunks(encoded):
+            pending += chunk
+            usable = len(pending) - len(pending) % 4
+            yield binascii.a2b_base64(pending[:usable])
+            pending = pending[usable:]
+        if pending:
+            # Tolerate missing padding like email's own decoder does
+            yield binascii.a2b_base64(pending + '=' * (-len(pending) % 4))
+
+    def _base64_chunks(self, encoded):
+        """
+        Yield encoded in STREAM_CHUNK_SIZE slices with everything outside the base64 alphabet removed;
+        a stray character would otherwise shift every 4-character group after it
+        """
+        for start in range(0, len(encoded), self.STREAM_CHUNK_SIZE):
+            yield re.sub(r'[^A-Za-z0-9+/]', '', encoded[start:start + self.STREAM_CHUNK_SIZE])
+
+    def _extract_zip(self, zip_path, directory, depth=0):
+        """
+        Extract a ZIP into directory with bounded memory: members are decompressed in chunks to temp
+        files on the ZIP worker pool, then deduplicated and renamed into place in archive order.
+        Nested ZIPs are extracted the same way, up to MAX_ZIP_DEPTH levels.
+        Raises zipfile.BadZipFile if zip_path is not a valid ZIP.
+        """
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            members = [info.filename for info in zip_ref.infolist()
+                       if not info.is_dir() and os.path.basename(info.filename)]
+
+        futures = [self.zip_executor.submit(self._stream_zip_member, zip_path, member, directory)
+                   for member in members]
+        try:
+            for member, future in zip(members, futures):
+                base_name = os.path.basename(member)
+                temp_path, zipped_hash = future.result()
+
+                # Skip if we've already downloaded this exact content
+                if zipped_hash in self.downloaded_files:
+                    os.remove(temp_path)
+                    print(f"Skipping duplicate file from ZIP: {base_name} (identical content exists as {self.downloaded_files[zipped_hash]})")
+                    continue
+
+                # Only real .zip members: .xlsx/.docx files are ZIPs too but are kept whole
+                if depth < self.MAX_ZIP_DEPTH and base_name.lower().endswith('.zip') and zipfile.is_zipfile(temp_path):
+                    try:
+                        self._extract_zip(temp_path, directory, depth + 1)
+                        print(f"Extracted nested ZIP: {base_name}")
+                        os.remove(temp_path)
+                        continue
+                    except zipfile.BadZipFile:
+                        print(f"Warning: nested {base_name} is not a valid ZIP file, keeping it as is")
+
+                # Handle potential filename conflicts and move the extracted file into place
+                final_name = self._commit_temp_file(directory, base_name, temp_path, zipped_hash)
+                if final_name is None:
+                    print(f"Skipping duplicate file from ZIP: {base_name} (identical file already exists)")
+                    continue
+                print(f"Extracted from ZIP: {final_name}")
+
+                # Record the extracted file
+                self.downloaded_files[zipped_hash] = final_name
+        finally:
+            # Don't leave temp files behind if a member failed part way through
+            for future in futures:
+                if not future.cancel() and future.exception() is None:
+                    leftover = future.result()[0]
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+
+    def _extract_downloaded_zip(self, temp_path, directory, filename):
+        """
+        Extract a downloaded ZIP from its temp file and remove it, so the archive is never stored
+        next to its members. Returns False, leaving the temp file in place, if it is not a valid ZIP.
+        """
+        try:
+            self._extract_zip(temp_path, directory)
+        except zipfile.BadZipFile:
+            print(f"Warning: {filename} is not a valid ZIP file")
+            return False
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        os.remove(temp_path)
+        print(f"Extracted all contents from: {filename}")
+        return True
+
+    def _stream_zip_member(self, zip_path, member, directory):
+        """Decompress one ZIP member to a temp file in chunks. Runs on the ZIP worker pool."""
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref, zip_ref.open(member) as source:
+            temp_path, content_hash, _ = self._stream_to_temp_file(
+                directory, iter(lambda: source.read(self.STREAM_CHUNK_SIZE), b''))
+        return temp_path, content_hash
+
+    def _directory_index(self, directory):
+        """
+        In-memory index of a download folder, built once per run with os.scandir:
+        {'files': {normcased name: [size, hash or None]}, 'next_suffix': {(base, ext): n}}.
+        Hashes of existing files are only computed when a same-named file of equal size arrives.
+        """
+        index = self._dir_index.get(directory)
+        if index is None:
+            files = {}
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        files[os.path.normcase(entry.name)] = [entry.stat().st_size, None]
+            index = {'files': files, 'next_suffix': {}}
+            self._dir_index[directory] = index
+        return index
+
+    def _index_add(self, directory, filename, size, content_hash):
+        """Record a file written to directory in its index"""
+        self._directory_index(directory)['files'][os.path.normcase(filename)] = [size, content_hash]
+
+    def _handle_duplicate_file(self, directory, filename, content=None, content_hash=None, size=None):
         """
         Handle potential duplicate files intelligently.
+        Pass either the new file's content or its content_hash (and size, if known).
         Returns (final_filename, is_duplicate) where is_duplicate indicates if the exact file already exists.
         """
         base_name, ext = os.path.splitext(filename)
+        if content is not None:
+            content_hash = self._calculate_file_hash(content)
+            size = len(content)
+        index = self._directory_index(directory)
+        files = index['files']
         
         # First check if file with exact name exists
-        existing_path = os.path.join(directory, filename)
-        if os.path.exists(existing_path):
-            # If file exists, check if content matches
-            with open(existing_path, 'rb') as f:
-                existing_content = f.read()
-                existing_hash = self._calculate_file_hash(existing_content)
-                new_hash = self._calculate_file_hash(content)
-                
-                if existing_hash == new_hash:
-                    # Exact same file, no need to save
-                    return filename, True
+        existing = files.get(os.path.normcase(filename))
+        if existing is not None and (size is None or existing[0] == size):
+            # Same name and size, check if content matches (hashing the existing file only once per run)
+            if existing[1] is None:
+                existing[1] = self._calculate_path_hash(os.path.join(directory, filename))
+            if existing[1] == content_hash:
+                # Exact same file, no need to save
+                return filename, True
         
         # At this point, either file doesn't exist, or content is different
-        # Generate unique filename if needed
+        # Generate unique filename if needed, continuing from the last suffix handed out for this name
         final_name = filename
-        counter = 1
-        while os.path.exists(os.path.join(directory, final_name)):
+        suffix_key = (os.path.normcase(base_name), os.path.normcase(ext))
+        counter = index['next_suffix'].get(suffix_key, 1)
+        while os.path.normcase(final_name) in files:
             final_name = f"{base_name}_{counter}{ext}"
             counter += 1
+        if final_name != filename:
+            index['next_suffix'][suffix_key] = counter
             
         return final_name, False
 
     def select_folder(self, folder_name):
         try:
             self.imap.select(folder_name)
+            self.folder = folder_name
+            self.uidvalidity = self._get_uidvalidity(folder_name)
             print(f"Selected folder: {folder_name}")
         except imaplib.IMAP4.error as e:
             print(f"Error selecting folder {folder_name}: {e}")
             sys.exit(1)
 
+    def _get_uidvalidity(self, folder_name):
+        """Return the UIDVALIDITY of the selected folder, or None if the server doesn't report it"""
+        return self._get_uidvalidity_of(self.imap, folder_name)
+
+    def _get_uidvalidity_of(self, imap, folder_name):
+        # SELECT normally carries UIDVALIDITY as an untagged response
+        _, data = imap.response('UIDVALIDITY')
+        if not data or data[0] is None:
+            # Fall back to an explicit STATUS query
+            typ, data = imap.status(folder_name, '(UIDVALIDITY)')
+            if typ != 'OK' or not data or data[0] is None:
+                return None
+            match = re.search(rb'UIDVALIDITY (\d+)', data[0])
+            return int(match.group(1)) if match else None
+        return int(data[0])
+
     def __enter__(self):
         self.emails = self._get_all_messages()
         return self
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        self.imap.close()
-        self.imap.logout()
+        self.link_executor.shutdown(wait=True)
+        self.zip_executor.shutdown(wait=True)
+        self.state.close()
+        self.http.close()
+        if self.imap is not None:
+            self.imap.close()
+            self.imap.logout()
+
+    def _uid_sync_enabled(self):
+        return self.USE_UID_SYNC and self.uidvalidity is not None
+
+    def _message_key(self, email_id):
+        """Key under which a message is recorded in processed_ids"""
+        if self._uid_sync_enabled():
+            # UIDs are only stable for a given folder and UIDVALIDITY
+            return (self.folder, self.uidvalidity, int(email_id))
+        return email_id
 
     def _get_all_messages(self):
-        _, messages = self.imap.search(None, 'ALL')
+        self.search_started = datetime.now()
+        if self._uid_sync_enabled():
+            return self._get_new_uids()
+
+        state = self.sync_state.get(self.folder) or {}
+        # A date recorded under a UID watermark only held for that UIDVALIDITY, so don't trust it here
+        last_sync_date = state.get('last_sync_date') if not state.get('uidvalidity') else None
+        _, messages = self.imap.search(None, *self._search_criteria(last_sync_date) or ['ALL'])
         all_ids = messages[0].split()
         # Filter out already processed IDs
         new_ids = [id for id in all_ids if id not in self.processed_ids]
         print(f"Found {len(new_ids)} new emails to process")
         return new_ids
 
+    def _get_new_uids(self):
+        """Ask the server only for UIDs above the last synced one in the selected folder"""
+        state = self.sync_state.get(self.folder)
+        if state is None or state['uidvalidity'] != self.uidvalidity:
+            if state is not None:
+                print(f"UIDVALIDITY of {self.folder} changed ({state['uidvalidity']} -> {self.uidvalidity}), doing a full resync")
+                # UIDs recorded under the old UIDVALIDITY no longer identify the same messages
+                self.processed_ids.discard_folder(self.folder)
+            # Drop the date watermark too: a full resync must not be narrowed to SINCE the last run
+            state = {'uidvalidity': self.uidvalidity, 'last_uid': 0, 'last_sync_date': None}
+            self.sync_state[self.folder] = state
+
+        if state['last_uid']:
+            criteria = [f"UID {state['last_uid'] + 1}:*"] + self._search_criteria()
+        else:
+            criteria = self._search_criteria(state['last_sync_date']) or ['ALL']
+        _, messages = self.imap.uid('SEARCH', None, *criteria)
+
+        # "n:*" always matches the highest UID in the folder, even when it is below n
+        new_uids = [uid for uid in messages[0].split()
+                    if int(uid) > state['last_uid'] and self._message_key(uid) not in self.processed_ids]
+        new_uids.sort(key=int)
+        print(f"Found {len(new_uids)} new emails to process (last synced UID: {state['last_uid']})")
+        return new_uids
+
+    def _search_criteria(self, last_sync_date=None):
+        """
+        SEARCH keys for SEARCH_SINCE, SEARCH_FROM and SEARCH_UNKEYWORD. last_sync_date ('YYYY-MM-DD')
+        narrows SINCE further; pass it only when no UID watermark limits the search already.
+        """
+        criteria = []
+        since = self.SEARCH_SINCE
+        if self.USE_SYNC_DATE_WATERMARK and last_sync_date:
+            watermark = datetime.strptime(last_sync_date, '%Y-%m-%d') - timedelta(days=self.SYNC_DATE_OVERLAP_DAYS)
+            since = max(since, watermark) if since else watermark
+        if since:
+            # IMAP dates use English month names whatever the locale, so don't use strftime's %b
+            month = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')[since.month - 1]
+            criteria.append(f'SINCE {since.day:02d}-{month}-{since.year}')
+        if self.SEARCH_FROM:
+            # OR takes two keys, so n senders need n - 1 ORs in front
+            criteria.append('OR ' * (len(self.SEARCH_FROM) - 1) + ' '.join(f'FROM "{sender}"' for sender in self.SEARCH_FROM))
+        for keyword in self.SEARCH_UNKEYWORD + ((self.DONE_KEYWORD,) if self.USE_KEYWORD_CLAIMS else ()):
+            criteria.append(f'UNKEYWORD {keyword}')
+        return criteria
+
+    def _update_sync_state(self, uids):
+        """
+        Advance the folder's last synced UID past the processed UIDs.
+        The watermark stops at the first failed message so it is retried next run;
+        successes above it stay in processed_ids until the watermark catches up.
+        When every message succeeded, the date the search ran becomes the folder's date watermark.
+        """
+        if not self._uid_sync_enabled():
+            if all(email_id in self.processed_ids for email_id in uids):
+                state = self.sync_state.get(self.folder) or {'uidvalidity': 0, 'last_uid': 0}
+                state['last_sync_date'] = self.search_started.strftime('%Y-%m-%d')
+                self.sync_state[self.folder] = state
+                self.state.commit()
+            return
+
+        state = self.sync_state[self.folder]
+        for uid in sorted(uids, key=int):
+            if self._message_key(uid) not in self.processed_ids:
+                break
+            state['last_uid'] = int(uid)
+        else:
+            state['last_sync_date'] = self.search_started.strftime('%Y-%m-%d')
+        self.sync_state[self.folder] = state
+
+        # Keys at or below the watermark are covered by last_uid
+        self.processed_ids.discard_through(self.folder, self.uidvalidity, state['last_uid'])
+        self.state.commit()
+
     def fetch_message(self, num):
         # If num is bytes (email_id), use it directly
         if isinstance(num, bytes):
@@ -146,12 +678,242 @@ class MailBox:
         # If num is an integer index, get the email_id from self.emails
         else:
             email_id = self.emails[num]
-            
-        _, data = self.imap.fetch(email_id, '(RFC822)')
+
+        if self._uid_sync_enabled():
+            _, data = self.imap.uid('FETCH', email_id, '(RFC822)')
+        else:
+            _, data = self.imap.fetch(email_id, '(RFC822)')
         _, bytes_data = data[0]
         email_message = email.message_from_bytes(bytes_data)
         return email_message
 
+    def fetch_messages(self, email_ids, batch_size=None):
+        """
+        Fetch messages in chunks of batch_size IDs per FETCH command.
+        Yields (email_id, email_message) one message at a time in the order the server returns them.
+        """
+        batch_size = max(1, batch_size or self.FETCH_BATCH_SIZE)
+
+        for start in range(0, len(email_ids), batch_size):
+            batch = email_ids[start:start + batch_size]
+            try:
+                if self.USE_PARTIAL_FETCH:
+                    yield from self._fetch_partial_batch(batch)
+                else:
+                    for email_id, literals, _ in self._fetch_items(batch, 'RFC822'):
+                        if b'RFC822' in literals:
+                            yield email_id, email.message_from_bytes(literals[b'RFC822'])
+            except imaplib.IMAP4.error as e:
+                # Messages of a failed batch stay unprocessed and are retried next run
+                print(f"Error fetching emails {b','.join(batch).decode()}: {e}")
+
+    def _fetch_items(self, email_ids, items):
+        """
+        Run one FETCH for email_ids and return [(email_id, literals, response), ...]
+        skipping unsolicited responses such as flag updates.
+        """
+        message_set = b','.join(email_ids).decode()
+        if self._uid_sync_enabled():
+            _, data = self.imap.uid('FETCH', message_set, f'(UID {items})')
+        else:
+            _, data = self.imap.fetch(message_set, f'({items})')
+
+        results = []
+        for response in self._parse_fetch_response(data):
+            email_id = response['uid'] if self._uid_sync_enabled() else response['seq']
+            if email_id in email_ids:
+                self.fetched_bytes += sum(len(literal) for literal in response['literals'].values())
+                results.append((email_id, response['literals'], response))
+        return results
+
+    def _fetch_partial_batch(self, email_ids):
+        """
+        Fetch BODYSTRUCTURE for a batch first, then only the MIME sections we use:
+        attachments with an allowed extension and the first text/html part.
+        Messages needing the same sections share one FETCH command.
+        """
+        groups = {}
+        for email_id, _, response in self._fetch_items(email_ids, 'BODYSTRUCTURE'):
+            structure = re.search(rb'BODYSTRUCTURE (\(.*\))', response['text'], re.DOTALL)
+            parts = self._parse_bodystructure(self._parse_imap_list(structure.group(1))[0]) if structure else None
+            if parts is None or any(part['opaque'] for part in parts):
+                # Single-part message, unreadable structure or a part we can't address: fetch the whole message
+                sections = None
+            else:
+                sections = tuple(part['section'] for part in self._select_wanted_parts(parts, self.routes.get(email_id, 'all')))
+            groups.setdefault(sections, []).append(email_id)
+
+        for sections, group_ids in groups.items():
+            if sections is None:
+                for email_id, literals, _ in self._fetch_items(group_ids, 'RFC822'):
+                    if b'RFC822' in literals:
+                        yield email_id, email.message_from_bytes(literals[b'RFC822'])
+                continue
+
+            items = ['BODY.PEEK[HEADER]']
+            for section in sections:
+                items += [f'BODY.PEEK[{section}.MIME]', f'BODY.PEEK[{section}]']
+            for email_id, literals, _ in self._fetch_items(group_ids, ' '.join(items)):
+                yield email_id, self._build_partial_message(literals, sections)
+
+    def _build_partial_message(self, literals, sections):
+        """Rebuild a multipart message holding only the fetched sections, so the normal walk() still works"""
+        email_message = email.message_from_bytes(literals.get(b'BODY[HEADER]', b''))
+        email_message.set_payload([])
+        for section in sections:
+            mime_headers = literals.get(f'BODY[{section}.MIME]'.encode(), b'')
+            body = literals.get(f'BODY[{section}]'.encode(), b'')
+            email_message.attach(email.message_from_bytes(mime_headers + body))
+        return email_message
+
+    def _select_wanted_parts(self, parts, route='all'):
+        """
+        Pick attachments with an allowed extension and the first text/html part from a parsed BODYSTRUCTURE,
+        leaving out the HTML for the 'attachments' route and the attachments for the 'links' route
+        """
+        wanted = []
+        html_found = False
+        for part in parts:
+            # Mailers often mark the body 'inline'; only an attached HTML file is not the body
+            if (part['type'] == 'text' and part['subtype'] == 'html' and not html_found
+                    and part['disposition'] != 'attachment'):
+                if route != 'attachments':
+                    wanted.append(part)
+                html_found = True
+            elif part['disposition'] and part['filename'] and route != 'links':
+                ext = os.path.splitext(part['filename'])[1].lower()
+                if self.ATTACHMENT_EXTENSIONS is None or ext in self.ATTACHMENT_EXTENSIONS:
+                    wanted.append(part)
+        return wanted
+
+    def _parse_bodystructure(self, structure, prefix=''):
+        """
+        Flatten a parsed BODYSTRUCTURE into leaf parts with their section numbers, descending into
+        forwarded messages (message/rfc822) like walk() does. Returns None for a single-part message.
+        Parts whose contents can't be addressed this way are marked 'opaque'.
+        """
+        if not structure or not isinstance(structure[0], list):
+            if prefix:
+                return [self._describe_part(structure, prefix)]
+            return None
+
+        parts = []
+        for index, child in enumerate(structure, 1):
+            if not isinstance(child, list):
+                break  # Reached the multipart subtype and extension data
+            section = f'{prefix}.{index}' if prefix else str(index)
+            if child and isinstance(child[0], list):
+                parts.extend(self._parse_bodystructure(child, section))
+                continue
+            part = self._describe_part(child, section)
+            if (part['type'], part['subtype']) == ('message', 'rfc822'):
+                # The forwarded message's own body structure is field 8; its parts are numbered under this section
+                nested = child[8] if len(child) > 8 else None
+                if isinstance(nested, list) and nested and isinstance(nested[0], list):
+                    parts.extend(self._parse_bodystructure(nested, section))
+                    continue
+                part['opaque'] = True
+            parts.append(part)
+        return parts
+
+    def _describe_part(self, fields, section):
+        def pairs(value):
+            if not isinstance(value, list):
+                return {}
+            return {str(k).lower(): v for k, v in zip(value[::2], value[1::2])}
+
+        maintype = (fields[0] or '').lower()
+        subtype = (fields[1] or '').lower()
+        # Disposition follows the type-specific fields (lines for text/*, envelope/body/lines for message/rfc822)
+        if maintype == 'text':
+            disposition_index = 9
+        elif (maintype, subtype) == ('message', 'rfc822'):
+            disposition_index = 11
+        else:
+            disposition_index = 8
+        disposition = fields[disposition_index] if len(fields) > disposition_index else None
+        disposition = disposition if isinstance(disposition, list) and disposition else None
+
+        params = pairs(fields[2])
+        if disposition:
+            params.update(pairs(disposition[1] if len(disposition) > 1 else None))
+        # Joins RFC 2231 continuations (filename*0*=utf-8''..., filename*1*=...) and decodes their charset
+        params = dict(email.utils.decode_params([('', '')] + [(k, v) for k, v in params.items() if v is not None])[1:])
+        filename = None
+        for key in ('filename', 'name'):
+            value = params.get(key)
+            if value:
+                # decode_params hands values back quoted
+                value = email.utils.unquote(email.utils.collapse_rfc2231_value(value))
+                filename = value if isinstance(params[key], tuple) else str(make_header(decode_header(value)))
+                break
+
+        disposition = disposition[0].lower() if disposition else None
+        return {
+            'section': section,
+            'type': maintype,
+            'subtype': subtype,
+            'disposition': disposition,
+            'filename': filename,
+            # An attachment whose name we could not read is left to the full-message path
+            'opaque': disposition == 'attachment' and not filename,
+        }
+
+    def _parse_imap_list(self, text):
+        """Parse an IMAP parenthesized list into nested Python lists of str (NIL becomes None)"""
+        tokens = re.findall(rb'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+', text)
+        root = []
+        stack = [root]
+        for token in tokens:
+            if token == b'(':
+                stack[-1].append([])
+                stack.append(stack[-1][-1])
+            elif token == b')':
+                if len(stack) > 1:
+                    stack.pop()
+            elif token.startswith(b'"'):
+                stack[-1].append(re.sub(rb'\\(.)', rb'\1', token[1:-1]).decode('utf-8', errors='replace'))
+            elif token.upper() == b'NIL':
+                stack[-1].append(None)
+            else:
+                stack[-1].append(token.decode('utf-8', errors='replace'))
+        return root
+
+    def _parse_fetch_response(self, data):
+        """
+        Group the raw imaplib FETCH response by message.
+        Returns a list of dicts with the message's sequence number, its UID (if returned),
+        the non-literal response text and a mapping of item name (e.g. b'RFC822', b'BODY[2]') to literal bytes.
+        """
+        responses = []
+        for item in data:
+            if item is None:
+                continue
+            text, literal = item if isinstance(item, tuple) else (item, None)
+            start = re.match(rb'(\d+) \(', text)
+            if start:
+                responses.append({'seq': start.group(1), 'uid': None, 'text': b'', 'literals': {}})
+            if not responses:
+                continue
+            response = responses[-1]
+            if literal is None:
+                response['text'] += text
+                continue
+            name = re.search(rb'(RFC822(?:\.HEADER|\.TEXT)?|BODY\[[^\]]*\])(?:<\d+>)? \{\d+\}$', text, re.IGNORECASE)
+            if name:
+                response['text'] += text
+                response['literals'][name.group(1).upper()] = literal
+            else:
+                # A literal inside a structure (e.g. a non-ASCII filename in BODYSTRUCTURE), inline it as a quoted string
+                quoted = b'"' + literal.replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
+                response['text'] += re.sub(rb'\{\d+\}$', lambda _: quoted, text)
+
+        for response in responses:
+            uid = re.search(rb'UID (\d+)', response['text'])
+            if uid:
+                response['uid'] = uid.group(1)
+        return responses
+
     def download_attachments(self, email_message):
         for part in email_message.walk():
             if part.get_content_maintype() == 'multipart':
@@ -165,109 +927,104 @@ class MailBox:
                 if decode_header(filename)[0][1] is not None:
                     filename = decode_header(filename)[0][0].decode(decode_header(filename)[0][1])
                 
-                # Get the attachment content
-                content = part.get_payload(decode=True)
-                content_hash = self._calculate_file_hash(content)
+                # Stream the decoded attachment to a temp file in the BlueDart folder, hashing as it is written
+                temp_path, content_hash, _ = self._stream_to_temp_file(self.bluedart_dir, self._iter_part_payload(part))
                 
                 # Check if we've already downloaded this exact content somewhere
                 if content_hash in self.downloaded_files:
+                    os.remove(temp_path)
                     print(f"Skipping duplicate attachment: {filename} (identical content exists as {self.downloaded_files[content_hash]})")
                     continue
                 
-                # Handle potential filename conflicts
-                final_filename, is_duplicate = self._handle_duplicate_file(self.bluedart_dir, filename, content)
-                if is_duplicate:
+                # ZIPs are extracted straight from the temp file and not kept themselves
+                if filename.lower().endswith('.zip'):
+                    print(f"Downloaded BlueDart ZIP attachment: {filename}")
+                    if self._extract_downloaded_zip(temp_path, self.bluedart_dir, filename):
+                        continue
+                
+                # Handle potential filename conflicts and move the temp file into place
+                final_filename = self._commit_temp_file(self.bluedart_dir, filename, temp_path, content_hash)
+                if final_filename is None:
                     print(f"Skipping duplicate attachment: {filename} (identical file already exists)")
                     continue
                 
                 # Save BlueDart attachments in BlueDart folder
-                filepath = os.path.join(self.bluedart_dir, final_filename)
-                
-                # Save the attachment
-                with open(filepath, 'wb') as f:
-                    f.write(content)
                 print(f"Downloaded BlueDart attachment: {final_filename}")
                 
                 # Record the downloaded file
                 self.downloaded_files[content_hash] = final_filename
-                
-                # Check if it's a ZIP file
-                if final_filename.lower().endswith('.zip'):
-                    try:
-                        # Extract ZIP contents with handling for duplicate filenames
-                        with zipfile.ZipFile(filepath, 'r') as zip_ref:
-                            for zipped_file in zip_ref.namelist():
-                                # Get the base filename
-                                base_name = os.path.basename(zipped_file)
-                                if not base_name:  # Skip if it's a directory
-                                    continue
-                                    
-                                # Read the zipped file content
-                                with zip_ref.open(zipped_file) as source:
-                                    zipped_content = source.read()
-                                    zipped_hash = self._calculate_file_hash(zipped_content)
-                                    
-                                    # Skip if we've already downloaded this exact content
-                                    if zipped_hash in self.downloaded_files:
-                                        print(f"Skipping duplicate file from ZIP: {base_name} (identical content exists as {self.downloaded_files[zipped_hash]})")
-                                        continue
-                                    
-                                    # Handle potential filename conflicts
-                                    final_name, is_duplicate = self._handle_duplicate_file(self.bluedart_dir, base_name, zipped_content)
-                                    if is_duplicate:
-                                        print(f"Skipping duplicate file from ZIP: {base_name} (identical file already exists)")
-                                        continue
-                                    
-                                    # Extract with the unique filename
-                                    with open(os.path.join(self.bluedart_dir, final_name), 'wb') as target:
-                                        target.write(zipped_content)
-                                    print(f"Extracted from ZIP: {final_name}")
-                                    
-                                    # Record the extracted file
-                                    self.downloaded_files[zipped_hash] = final_name
-                        
-                        print(f"Extracted all contents from: {final_filename}")
-                        # Remove ZIP file after extraction
-                        os.remove(filepath)
-                        # Remove ZIP file hash from downloaded files since we deleted it
-                        self.downloaded_files.pop(content_hash, None)
-                        print(f"Removed ZIP file after extraction")
-                        
-                    except zipfile.BadZipFile:
-                        print(f"Warning: {final_filename} is not a valid ZIP file")
 
     def process_email_body(self, email_message):
-        # Get email body
+        # Get the raw HTML (or single-part) body
+        body_part = None
         if email_message.is_multipart():
             for part in email_message.walk():
                 if part.get_content_type() == "text/html":
-                    try:
-                        # Try default decoding
-                        body = part.get_payload(decode=True).decode()
-                    except UnicodeDecodeError:
-                        try:
-                            # Try to detect encoding using chardet
-                            raw_body = part.get_payload(decode=True)
-                            detected = chardet.detect(raw_body)
-                            body = raw_body.decode(detected['encoding'] or 'utf-8', errors='replace')
-                        except Exception:
-                            # If all else fails, use 'replace' error handler
-                            body = raw_body.decode('utf-8', errors='replace')
+                    body_part = part
                     break
         else:
+            body_part = email_message
+        raw_body = body_part.get_payload(decode=True) if body_part is not None else None
+        if not raw_body:
+            return []
+
+        # Cheap byte-level check before any decoding or parsing: BlueDart mails never mention Delhivery
+        lowered = raw_body.lower()
+        if self.FAST_LINK_SCAN and not all(word in lowered for word in (b'delhivery', b'download', b'invoice')):
+            return []
+
+        sender = email.utils.parseaddr(email_message.get('From', ''))[1].lower()
+        body = self._decode_body(raw_body, body_part.get_content_charset(), sender)
+
+        hrefs = None
+        if self.FAST_LINK_SCAN:
             try:
-                # Try default decoding
-                body = email_message.get_payload(decode=True).decode()
-            except UnicodeDecodeError:
-                try:
-                    # Try to detect encoding using chardet
-                    raw_body = email_message.get_payload(decode=True)
-                    detected = chardet.detect(raw_body)
-                    body = raw_body.decode(detected['encoding'] or 'utf-8', errors='replace')
-                except Exception:
-                    # If all else fails, use 'replace' error handler
-                    body = raw_body.decode('utf-8', errors='replace')
+                hrefs = InvoiceLinkParser.scan(body)
+            except Exception as e:
+                print(f"Fast link scan failed ({e}), falling back to a full HTML parse")
+        if hrefs is None:
+            hrefs = self._find_invoice_links_soup(body)
+
+        # Queue the downloads on the shared link pool; the caller waits for the returned futures
+        link_downloads = []
+        for href in hrefs:
+            if href and 'delhivery' in href.lower():  # Check if it's a Delhivery link
+                print(f"Found Delhivery download link: {href}")
+                # Reminder emails repeat the same link; download it once per run
+                with self._state_lock:
+                    future = self._link_futures.get(href)
+                    if future is None:
+                        future = self._link_futures[href] = self.link_executor.submit(self._download_link, href)
+                link_downloads.append(future)
+        return link_downloads
+
+    def _decode_body(self, raw_body, declared_charset, sender):
+        """
+        Decode a body with the MIME-declared charset, then UTF-8, then the charset last detected for this sender.
+        Only if all of those fail, run chardet on a bounded prefix sample and remember the result for the sender.
+        """
+        candidates = []
+        for charset in (declared_charset, 'utf-8', self.sender_charsets.get(sender)):
+            if charset and charset not in candidates:
+                candidates.append(charset)
+        for charset in candidates:
+            try:
+                return raw_body.decode(charset)
+            except (UnicodeDecodeError, LookupError):
+                continue
 
+        try:
+            # Try to detect encoding using chardet on a sample instead of the whole body
+            detected = chardet.detect(raw_body[:self.CHARSET_SAMPLE_BYTES])['encoding'] or 'utf-8'
+            body = raw_body.decode(detected, errors='replace')
+            self.sender_charsets[sender] = detected
+            return body
+        except (LookupError, TypeError):
+            # If all else fails, use 'replace' error handler
+            return raw_body.decode('utf-8', errors='replace')
+
+    def _find_invoice_links_soup(self, body):
+        """Full BeautifulSoup parse for "Download Invoice(s)" links, returns their hrefs"""
         # Parse HTML and look for Download Invoice/Invoices button/link
         soup = BeautifulSoup(body, 'html.parser')
         
@@ -281,157 +1038,773 @@ class MailBox:
                 link = cell.find('a')
                 if link and any(phrase in link.text.lower() for phrase in ['download invoice', 'download invoices']):
                     download_links.append(link)
-        
-        for link in download_links:
-            href = link.get('href')
-            if href and 'delhivery' in href.lower():  # Check if it's a Delhivery link
+        return [link.get('href') for link in download_links]
+
+    def _create_http_session(self):
+        """Keep-alive session shared by the link download workers, retrying with exponential backoff"""
+        session = requests.Session()
+        retry = Retry(
+            total=self.LINK_RETRIES,
+            backoff_factor=self.LINK_BACKOFF,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['GET'],
+        )
+        adapter = HTTPAdapter(pool_connections=self.LINK_DOWNLOAD_WORKERS,
+                              pool_maxsize=self.LINK_DOWNLOAD_WORKERS, max_retries=retry)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def _download_link(self, href):
+        """
+        Download one Delhivery invoice link and save it. Runs on the link pool.
+        Returns False if the download failed, so the email isn't marked as processed.
+        With USE_LINK_CACHE a link whose content was already saved is skipped without a request
+        (or revalidated with a conditional GET under LINK_REVALIDATE), and a download interrupted
+        in an earlier attempt continues from its partial file with a Range request.
+        """
+        temp_path = None
+        keep_partial = False
+        cached = self.link_cache.get(href) if self.USE_LINK_CACHE else None
+        with self._state_lock:
+            known = bool(cached and cached['content_hash'] and cached['content_hash'] in self.downloaded_files)
+        if known and not self.LINK_REVALIDATE:
+            print(f"Skipping already downloaded link: {href}")
+            with self._state_lock:
+                self.link_stats['cached'] += 1
+            return True
+
+        try:
+            headers = {}
+            resume_from = 0
+            if known:
+                # Only ask for the body again if it changed since it was saved
+                if cached['etag']:
+                    headers['If-None-Match'] = cached['etag']
+                if cached['last_modified']:
+                    headers['If-Modified-Since'] = cached['last_modified']
+            elif cached:
+                resume_from = self._resumable_size(href, cached)
+                if resume_from:
+                    # With If-Range the server sends the whole body instead if it changed meanwhile
+                    headers['Range'] = f'bytes={resume_from}-'
+                    headers['If-Range'] = self._strong_validator(cached)
+
+            # Stream the body to a temp file outside the state lock, hashing as it is written
+            with self.http.get(href, timeout=self.LINK_TIMEOUT, stream=True, headers=headers) as response:
+                if response.status_code == 304:
+                    print(f"Link unchanged since last download: {href}")
+                    with self._state_lock:
+                        self.link_stats['cached'] += 1
+                    return True
+                if response.status_code not in (200, 206):
+                    raise requests.HTTPError(f"HTTP {response.status_code}", response=response)
+                chunks = response.iter_content(chunk_size=self.STREAM_CHUNK_SIZE)
+                if not self.USE_LINK_CACHE:
+                    temp_path, content_hash, size = self._stream_to_temp_file(self.delhivery_dir, chunks)
+                else:
+                    validators = {'etag': response.headers.get('ETag'),
+                                  'last_modified': response.headers.get('Last-Modified')}
+                    with self._state_lock:
+                        # Record the validators first so an interrupted download can be resumed
+                        self.link_cache[href] = validators
+                        self.state.commit()
+                    temp_path = self._partial_path(href)
+                    keep_partial = self._strong_validator(validators) is not None
+                    resume = response.status_code == 206
+                    if resume:
+                        print(f"Resuming {href} from {resume_from} bytes")
+                    content_hash, size = self._stream_to_partial_file(temp_path, chunks, resume)
+                    keep_partial = False
+            with self._state_lock:
+                self.link_stats['downloaded'] += 1
+                self.link_stats['bytes'] += size
+                self._save_delhivery_response(href, response, temp_path, content_hash)
+                if self.USE_LINK_CACHE:
+                    self.link_cache[href] = dict(validators, content_hash=content_hash, size=size)
+            return True
+        except Exception as e:
+            print(f"Error downloading from {href}: {e}")
+            with self._state_lock:
+                self.link_stats['failed'].append(href)
+            return False
+        finally:
+            if temp_path and not keep_partial and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _partial_path(self, href):
+        return os.path.join(self.partial_dir, hashlib.sha256(href.encode()).hexdigest() + '.part')
+
+    def _strong_validator(self, entry):
+        """Validator usable in If-Range: a strong ETag, else Last-Modified, else None"""
+        if entry.get('etag') and not entry['etag'].startswith('W/'):
+            return entry['etag']
+        return entry.get('last_modified')
+
+    def _resumable_size(self, href, cached):
+        """Bytes already on disk from an interrupted download of href, or 0 if it can't be resumed"""
+        partial_path = self._partial_path(href)
+        if not os.path.exists(partial_path):
+            return 0
+        if self._strong_validator(cached) is None:
+            os.remove(partial_path)
+            return 0
+        return os.path.getsize(partial_path)
+
+    def _stream_to_partial_file(self, path, chunks, resume):
+        """
+        Write chunks to a link's partial file, appending when resuming a Range response.
+        The file is left in place if streaming fails. Returns (content_hash, size) of the whole file.
+        """
+        hasher = hashlib.sha256()
+        size = 0
+        if resume:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.STREAM_CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+                    size += len(chunk)
+        with open(path, 'ab' if resume else 'wb') as f:
+            for chunk in chunks:
+                if chunk:
+                    hasher.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        return hasher.hexdigest(), size
+
+    def _save_delhivery_response(self, href, response, temp_path, content_hash):
+        """Deduplicate and move into place (or extract) a Delhivery invoice file streamed to temp_path"""
+        # Check if we've already downloaded this exact content somewhere
+        if content_hash in self.downloaded_files:
+            print(f"Skipping duplicate Delhivery file (identical content exists as {self.downloaded_files[content_hash]})")
+            return
+
+        # Extract filename from Content-Disposition header or use default
+        content_disposition = response.headers.get('content-disposition')
+        if content_disposition:
+            filename = content_disposition.split('filename=')[-1].strip('"')
+        else:
+            url_filename = href.split('/')[-1]
+            filename = f"delhivery_invoice_{url_filename}_{time.strftime('%Y%m%d_%H%M%S')}"
+
+        # Check content type to determine if it's a ZIP file
+        content_type = response.headers.get('content-type', '').lower()
+        with open(temp_path, 'rb') as f:
+            is_zip = 'zip' in content_type or f.read(4) == b'PK\x03\x04'
+
+        if is_zip:
+            # Handle potential filename conflicts for ZIP
+            if not filename.lower().endswith('.zip'):
+                filename += '.zip'
+
+            print(f"Downloaded Delhivery ZIP file: {filename}")
+            if self._extract_downloaded_zip(temp_path, self.delhivery_dir, filename):
+                # Record the bundle so the link cache can skip or revalidate it like any other invoice
+                self.downloaded_files[content_hash] = filename
+                return
+
+            # Keep it as a regular file if ZIP extraction fails
+            final_filename = self._commit_temp_file(self.delhivery_dir, filename, temp_path, content_hash)
+            if final_filename is None:
+                print(f"Skipping duplicate ZIP file: {filename} (identical file already exists)")
+                return
+            self.downloaded_files[content_hash] = final_filename
+        else:
+            # Handle non-ZIP files
+            if not os.path.splitext(filename)[1]:  # If no extension
+                filename += '.pdf'  # Default to PDF
+
+            # Handle potential filename conflicts and move the temp file into place
+            final_name = self._commit_temp_file(self.delhivery_dir, filename, temp_path, content_hash)
+            if final_name is None:
+                print(f"Skipping duplicate file: {filename} (identical file already exists)")
+                return
+
+            print(f"Successfully downloaded Delhivery file: {final_name}")
+
+            # Record the downloaded file
+            self.downloaded_files[content_hash] = final_name
+
+    def _classify_messages(self, email_ids):
+        """
+        Route each pending email from a bulk FETCH of a few header fields, before any body is downloaded.
+        The first of CLASSIFICATION_RULES whose pattern matches the header wins, else DEFAULT_ROUTE.
+        Returns {email_id: route}.
+        """
+        fields = sorted({header.upper() for _, header, _ in self.CLASSIFICATION_RULES} | {'FROM', 'SUBJECT', 'CONTENT-TYPE', 'CONTENT-DISPOSITION'})
+        routes = {}
+        for start in range(0, len(email_ids), self.CLASSIFY_BATCH_SIZE):
+            batch = email_ids[start:start + self.CLASSIFY_BATCH_SIZE]
+            try:
+                responses = self._fetch_items(batch, f"BODY.PEEK[HEADER.FIELDS ({' '.join(fields)})]")
+            except imaplib.IMAP4.error as e:
+                # Unclassified emails go through every handler
+                print(f"Error fetching headers of emails {b','.join(batch).decode()}: {e}")
+                continue
+            for email_id, literals, _ in responses:
+                headers = email.message_from_bytes(next(iter(literals.values()), b''))
+                routes[email_id] = self._classify_headers(headers)
+        return routes
+
+    def _classify_headers(self, headers):
+        # A single-part message whose body is a file (e.g. a bare CSV) is never skipped
+        body_is_file = headers.get('content-disposition') is not None or \
+            re.search(r';\s*name\*?=', str(headers.get('content-type', '')), re.IGNORECASE)
+        for route, header, pattern in self.CLASSIFICATION_RULES:
+            if route == 'skip' and body_is_file:
+                continue
+            value = headers.get(header)
+            if value is not None and re.search(pattern, str(make_header(decode_header(value))), re.IGNORECASE):
+                return route
+        return self.DEFAULT_ROUTE
+
+    def _process_message(self, email_id, email_message):
+        """
+        Download attachments of one email and queue its invoice links.
+        Returns the link download futures, or None if processing failed.
+        """
+        try:
+            print(f"\nProcessing email: {email_message['subject']}")
+            route = self.routes.get(email_id, 'all')
+            
+            # Download attachments
+            if route != 'links':
+                with self._state_lock:
+                    self.download_attachments(email_message)
+            
+            # Process email body for Download Invoice button
+            return self.process_email_body(email_message) if route != 'attachments' else []
+            
+        except Exception as e:
+            print(f"Error processing email {email_id}: {e}")
+            return None
+
+    def _batch_queue(self, email_ids):
+        """Split email IDs into FETCH_BATCH_SIZE chunks on a queue that connections can take work from"""
+        batches = queue.Queue()
+        for start in range(0, len(email_ids), self.FETCH_BATCH_SIZE):
+            batches.put(email_ids[start:start + self.FETCH_BATCH_SIZE])
+        return batches
+
+    def _process_batches(self, batches):
+        """Fetch and process batches from the queue on this connection until it is empty"""
+        processed_count = 0
+        while True:
+            try:
+                batch = batches.get_nowait()
+            except queue.Empty:
+                break
+            self._flush_done_marks()
+            pending = []
+            for email_id, email_message in self.fetch_messages(self._claim_messages(batch)):
+                link_downloads = self._process_message(email_id, email_message)
+                if link_downloads is not None:
+                    pending.append((email_id, link_downloads))
+
+            # Let the batch's invoice links finish before marking its emails as processed
+            for email_id, link_downloads in pending:
+                if not self._links_downloaded(link_downloads):
+                    # Left unprocessed so the next run downloads its links again
+                    print(f"Not marking email {email_id} as processed, a link download failed")
+                    with self._state_lock:
+                        self.state.commit()
+                    continue
+                self._mark_processed(email_id)
+                processed_count += 1
+        return processed_count
+
+    def _links_downloaded(self, link_downloads):
+        """Wait for an email's link downloads and return True only if every one of them succeeded"""
+        concurrent.futures.wait(link_downloads)
+        return all(future.exception() is None and future.result() for future in link_downloads)
+
+    def _mark_processed(self, email_id, mark_done=True):
+        """Record an email as processed, committing its downloaded files and processed mark together"""
+        with self._state_lock:
+            self.processed_ids.add(self._message_key(email_id))
+            self.state.commit()
+            if mark_done and self.USE_KEYWORD_CLAIMS and self._uid_sync_enabled():
+                # Marked on the server by whichever connection flushes next; imaplib isn't thread-safe
+                self._done_uids.append(email_id)
+
+    def _host_keyword(self):
+        """Keyword naming this machine on the messages it claims, so it can release them after a crash"""
+        return '$TNBTHost_' + re.sub(r'[^A-Za-z0-9]', '', socket.gethostname())
+
+    def _claim_messages(self, uids):
+        """
+        Claim a batch for this machine by adding CLAIMED_KEYWORD on this connection, and return the UIDs won.
+        Messages another machine finished are recorded as processed; ones it holds claimed are left to it.
+        With CONDSTORE the STORE only applies to messages unchanged since their flags were read
+        (every change after that FETCH gets a higher mod-sequence), so two machines can't both win a message.
+        """
+        if not self.USE_KEYWORD_CLAIMS or not self._uid_sync_enabled() or not uids:
+            return uids
+
+        condstore = 'CONDSTORE' in self.imap.capabilities
+        _, data = self.imap.uid('FETCH', b','.join(uids), '(FLAGS MODSEQ)' if condstore else '(FLAGS)')
+        candidates, highest_modseq = [], 0
+        for response in self._parse_fetch_response(data):
+            flags = re.search(rb'FLAGS \(([^)]*)\)', response['text'])
+            keywords = {flag.lower() for flag in flags.group(1).decode().split()} if flags else set()
+            if self.DONE_KEYWORD.lower() in keywords:
+                self._mark_processed(response['uid'], mark_done=False)
+            elif self.CLAIMED_KEYWORD.lower() not in keywords:
+                candidates.append(response['uid'])
+                modseq = re.search(rb'MODSEQ \((\d+)\)', response['text'])
+                if modseq:
+                    highest_modseq = max(highest_modseq, int(modseq.group(1)))
+        if not candidates:
+            return []
+
+        store = '+FLAGS.SILENT'
+        if condstore and highest_modseq:
+            store = f'(UNCHANGEDSINCE {highest_modseq}) {store}'
+        # uid() only hands back untagged FETCH data, but MODIFIED comes in the tagged reply
+        typ, data = self.imap._simple_command('UID', 'STORE', b','.join(candidates), store,
+                                              f'({self.CLAIMED_KEYWORD} {self._host_keyword()})')
+        self.imap.untagged_responses.pop('FETCH', None)
+        if typ != 'OK':
+            print(f"Could not claim emails: {data}")
+            return []
+        # Messages another machine changed in the meantime are listed in a MODIFIED response code
+        modified = set()
+        match = re.search(rb'\[MODIFIED ([\d,:]+)\]', data[-1] or b'')
+        if match:
+            for piece in match.group(1).split(b','):
+                low, _, high = piece.partition(b':')
+                modified.update(range(int(low), int(high or low) + 1))
+        claimed = [uid for uid in candidates if int(uid) not in modified]
+        if len(claimed) < len(uids):
+            print(f"Claimed {len(claimed)} of {len(uids)} emails, the rest are done or claimed by another machine")
+        return claimed
+
+    def _flush_done_marks(self):
+        """Add DONE_KEYWORD to the emails finished so far and drop their claims, on this connection"""
+        with self._state_lock:
+            uids, self._done_uids[:] = list(self._done_uids), []
+        if uids:
+            uid_set = b','.join(uids)
+            self.imap.uid('STORE', uid_set, '+FLAGS.SILENT', f'({self.DONE_KEYWORD})')
+            self.imap.uid('STORE', uid_set, '-FLAGS.SILENT', f'({self.CLAIMED_KEYWORD} {self._host_keyword()})')
+
+    def release_claims(self, all_hosts=False):
+        """
+        Drop claims on unfinished emails so they are picked up again: this machine's own (left by a crash),
+        or with all_hosts=True every machine's, e.g. after one was retired mid-backlog.
+        """
+        criteria = ['KEYWORD', self.CLAIMED_KEYWORD, 'UNKEYWORD', self.DONE_KEYWORD]
+        if not all_hosts:
+            criteria += ['KEYWORD', self._host_keyword()]
+        _, data = self.imap.uid('SEARCH', None, *criteria)
+        uids = data[0].split()
+        if uids:
+            self.imap.uid('STORE', b','.join(uids), '-FLAGS.SILENT', f'({self.CLAIMED_KEYWORD} {self._host_keyword()})')
+            print(f"Released {len(uids)} claimed emails in {self.folder}")
+
+    def _open_worker_connections(self, count):
+        """Open up to count extra connections on the selected folder, sharing this mailbox's state and lock"""
+        workers = []
+        for _ in range(count):
+            try:
+                worker = copy.copy(self)  # Shares dedup state, sync state and the lock
+                worker.imap = self._connect()
+                worker.imap.select(self.folder)
+                if self._get_uidvalidity_of(worker.imap, self.folder) != self.uidvalidity:
+                    print("UIDVALIDITY changed while opening the connection pool, skipping extra connection")
+                    worker.imap.logout()
+                    continue
+                worker.fetched_bytes = 0
+                workers.append(worker)
+            except (imaplib.IMAP4.error, OSError) as e:
+                print(f"Could not open extra IMAP connection: {e}")
+        return workers
+
+    def _close_worker_connections(self, workers):
+        for worker in workers:
+            self.fetched_bytes += worker.fetched_bytes
+            try:
+                worker.imap.close()
+                worker.imap.logout()
+            except (imaplib.IMAP4.error, OSError):
+                pass
+
+    def _process_pooled(self, email_ids):
+        """
+        Split the pending IDs into FETCH batches and let POOL_SIZE connections work through them in parallel.
+        This connection takes part as well, so the run still completes if extra connections can't be opened.
+        """
+        batches = self._batch_queue(email_ids)
+        workers = self._open_worker_connections(self.POOL_SIZE - 1)
+        print(f"Processing {len(email_ids)} emails over {len(workers) + 1} IMAP connections")
+
+        if self.USE_PIPELINE:
+            # Every connection becomes a fetcher feeding the shared pipeline
+            processed_count = self._process_pipeline(batches, [self] + workers)
+            self._close_worker_connections(workers)
+            return processed_count
+
+        results = [0] * len(workers)
+
+        def run(index, worker):
+            try:
+                results[index] = worker._process_batches(batches)
+            except (imaplib.IMAP4.abort, OSError) as e:
+                print(f"IMAP connection {index + 2} failed: {e}")
+
+        threads = [threading.Thread(target=run, args=(index, worker), daemon=True)
+                   for index, worker in enumerate(workers)]
+        for thread in threads:
+            thread.start()
+        processed_count = self._process_batches(batches)
+        for thread in threads:
+            thread.join()
+
+        self._close_worker_connections(workers)
+        return processed_count + sum(results)
+
+    def queue_depths(self):
+        """Current number of items waiting in each pipeline stage's queue"""
+        return {stage: q.qsize() for stage, q in self.pipeline_queues.items()}
+
+    def _process_pipeline(self, batches, connections, mark_processed=True):
+        """
+        Staged pipeline over bounded queues so network waits overlap with CPU work and disk writes:
+          fetch  - one thread per IMAP connection pulls FETCH batches and queues parsed messages
+          parse  - PIPELINE_PARSE_WORKERS threads decode and scan HTML bodies and queue invoice link downloads
+          write  - one thread saves attachments under the state lock
+          finish - one thread waits for each email's link downloads and marks it processed
+        A full queue blocks the stage before it, which keeps the number of messages in memory bounded.
+        Any object with a fetch_messages(batch) generator can act as a connection, e.g. a MailArchive.
+        With mark_processed=False downloaded files are still committed but no message is marked processed.
+        Returns the number of emails finished.
+        """
+        parse_queue = queue.Queue(maxsize=self.PIPELINE_QUEUE_SIZE)
+        write_queue = queue.Queue(maxsize=self.PIPELINE_QUEUE_SIZE)
+        finish_queue = queue.Queue(maxsize=self.PIPELINE_QUEUE_SIZE)
+        self.pipeline_queues = {'parse': parse_queue, 'write': write_queue, 'finish': finish_queue}
+        stats = self.pipeline_stats = {
+            'processed': 0,
+            'peak_depth': {stage: 0 for stage in self.pipeline_queues},
+            'busy': {'fetch': 0.0, 'parse': 0.0, 'write': 0.0, 'finish': 0.0},
+        }
+        stats_lock = threading.Lock()
+
+        def put(stage, item):
+            self.pipeline_queues[stage].put(item)
+            with stats_lock:
+                stats['peak_depth'][stage] = max(stats['peak_depth'][stage], self.pipeline_queues[stage].qsize())
+
+        def busy(stage, started):
+            with stats_lock:
+                stats['busy'][stage] += time.perf_counter() - started
+
+        def fetch(connection):
+            try:
+                while True:
+                    try:
+                        batch = batches.get_nowait()
+                    except queue.Empty:
+                        break
+                    if mark_processed:
+                        connection._flush_done_marks()
+                        batch = connection._claim_messages(batch)
+                    messages = connection.fetch_messages(batch)
+                    while True:
+                        started = time.perf_counter()
+                        item = next(messages, None)
+                        busy('fetch', started)
+                        if item is None:
+                            break
+                        put('parse', item)
+            except (imaplib.IMAP4.abort, OSError) as e:
+                print(f"IMAP connection failed: {e}")
+
+        def parse():
+            for item in iter(parse_queue.get, None):
+                started = time.perf_counter()
+                email_id, email_message = item
                 try:
-                    print(f"Found Delhivery download link: {href}")
-                    response = requests.get(href)
-                    if response.status_code == 200:
-                        # Calculate hash of downloaded content
-                        content = response.content
-                        content_hash = self._calculate_file_hash(content)
-                        
-                        # Check if we've already downloaded this exact content somewhere
-                        if content_hash in self.downloaded_files:
-                            print(f"Skipping duplicate Delhivery file (identical content exists as {self.downloaded_files[content_hash]})")
-                            continue
-                        
-                        # Extract filename from Content-Disposition header or use default
-                        content_disposition = response.headers.get('content-disposition')
-                        if content_disposition:
-                            filename = content_disposition.split('filename=')[-1].strip('"')
-                        else:
-                            url_filename = href.split('/')[-1]
-                            filename = f"delhivery_invoice_{url_filename}_{time.strftime('%Y%m%d_%H%M%S')}"
-                        
-                        # Check content type to determine if it's a ZIP file
-                        content_type = response.headers.get('content-type', '').lower()
-                        is_zip = 'zip' in content_type or content[:4] == b'PK\x03\x04'
-                        
-                        if is_zip:
-                            # Handle potential filename conflicts for ZIP
-                            if not filename.lower().endswith('.zip'):
-                                filename += '.zip'
-                            
-                            final_filename, is_duplicate = self._handle_duplicate_file(self.delhivery_dir, filename, content)
-                            if is_duplicate:
-                                print(f"Skipping duplicate ZIP file: {filename} (identical file already exists)")
-                                continue
-                            
-                            zip_path = os.path.join(self.delhivery_dir, final_filename)
-                            with open(zip_path, 'wb') as f:
-                                f.write(content)
-                            print(f"Downloaded Delhivery ZIP file: {final_filename}")
-                            
-                            # Extract ZIP contents
-                            try:
-                                with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                                    for zipped_file in zip_ref.namelist():
-                                        base_name = os.path.basename(zipped_file)
-                                        if not base_name:  # Skip if it's a directory
-                                            continue
-                                        
-                                        # Read the zipped file content
-                                        with zip_ref.open(zipped_file) as source:
-                                            zipped_content = source.read()
-                                            zipped_hash = self._calculate_file_hash(zipped_content)
-                                            
-                                            # Skip if we've already downloaded this exact content
-                                            if zipped_hash in self.downloaded_files:
-                                                print(f"Skipping duplicate file from ZIP: {base_name} (identical content exists as {self.downloaded_files[zipped_hash]})")
-                                                continue
-                                            
-                                            # Handle potential filename conflicts
-                                            final_name, is_duplicate = self._handle_duplicate_file(self.delhivery_dir, base_name, zipped_content)
-                                            if is_duplicate:
-                                                print(f"Skipping duplicate file from ZIP: {base_name} (identical file already exists)")
-                                                continue
-                                            
-                                            # Extract with the unique filename
-                                            with open(os.path.join(self.delhivery_dir, final_name), 'wb') as target:
-                                                target.write(zipped_content)
-                                            print(f"Extracted from ZIP: {final_name}")
-                                            
-                                            # Record the extracted file
-                                            self.downloaded_files[zipped_hash] = final_name
-                                
-                                print(f"Extracted all contents from: {final_filename}")
-                                # Remove ZIP file after extraction
-                                os.remove(zip_path)
-                                print(f"Removed ZIP file after extraction")
-                            except zipfile.BadZipFile:
-                                print(f"Warning: Downloaded file is not a valid ZIP file")
-                                # Save as regular file if ZIP extraction fails
-                                final_name, is_duplicate = self._handle_duplicate_file(self.delhivery_dir, filename, content)
-                                if is_duplicate:
-                                    print(f"Skipping duplicate file: {filename} (identical file already exists)")
-                                    continue
-                                
-                                with open(os.path.join(self.delhivery_dir, final_name), 'wb') as f:
-                                    f.write(content)
-                                self.downloaded_files[content_hash] = final_name
-                        else:
-                            # Handle non-ZIP files
-                            if not os.path.splitext(filename)[1]:  # If no extension
-                                filename += '.pdf'  # Default to PDF
-                            
-                            # Handle potential filename conflicts
-                            final_name, is_duplicate = self._handle_duplicate_file(self.delhivery_dir, filename, content)
-                            if is_duplicate:
-                                print(f"Skipping duplicate file: {filename} (identical file already exists)")
-                                continue
-                            
-                            filepath = os.path.join(self.delhivery_dir, final_name)
-                            with open(filepath, 'wb') as f:
-                                f.write(content)
-                            print(f"Successfully downloaded Delhivery file: {final_name}")
-                            
-                            # Record the downloaded file
-                            self.downloaded_files[content_hash] = final_name
-                            
+                    print(f"\nProcessing email: {email_message['subject']}")
+                    # Process email body for Download Invoice button
+                    link_downloads = []
+                    if self.routes.get(email_id, 'all') != 'attachments':
+                        link_downloads = self.process_email_body(email_message)
                 except Exception as e:
-                    print(f"Error downloading from {href}: {e}")
+                    print(f"Error processing email {email_id}: {e}")
+                    continue
+                finally:
+                    busy('parse', started)
+                put('write', (email_id, email_message, link_downloads))
+
+        def write():
+            for item in iter(write_queue.get, None):
+                started = time.perf_counter()
+                email_id, email_message, link_downloads = item
+                try:
+                    # Download attachments
+                    if self.routes.get(email_id, 'all') != 'links':
+                        with self._state_lock:
+                            self.download_attachments(email_message)
+                except Exception as e:
+                    print(f"Error processing email {email_id}: {e}")
+                    continue
+                finally:
+                    busy('write', started)
+                put('finish', (email_id, link_downloads))
+
+        def finish():
+            for item in iter(finish_queue.get, None):
+                email_id, link_downloads = item
+                links_ok = self._links_downloaded(link_downloads)
+                started = time.perf_counter()
+                if mark_processed and links_ok:
+                    self._mark_processed(email_id)
+                else:
+                    with self._state_lock:
+                        self.state.commit()
+                if links_ok:
+                    stats['processed'] += 1
+                else:
+                    # Left unprocessed so the next run downloads its links again
+                    print(f"Not marking email {email_id} as processed, a link download failed")
+                busy('finish', started)
+
+        def start(target, *args):
+            thread = threading.Thread(target=target, args=args, daemon=True)
+            thread.start()
+            return thread
+
+        finisher = start(finish)
+        writer = start(write)
+        parsers = [start(parse) for _ in range(self.PIPELINE_PARSE_WORKERS)]
+        fetchers = [start(fetch, connection) for connection in connections]
+
+        # Report queue depths while the fetchers run, then drain the stages in order
+        for fetcher in fetchers:
+            while fetcher.is_alive():
+                fetcher.join(self.PIPELINE_REPORT_INTERVAL)
+                if fetcher.is_alive():
+                    print(f"Pipeline queue depths: {self.queue_depths()}")
+        for _ in parsers:
+            parse_queue.put(None)
+        for parser in parsers:
+            parser.join()
+        write_queue.put(None)
+        writer.join()
+        finish_queue.put(None)
+        finisher.join()
+
+        peaks = ', '.join(f"{stage} {depth}/{self.PIPELINE_QUEUE_SIZE}" for stage, depth in stats['peak_depth'].items())
+        busy_times = ', '.join(f"{stage} {seconds:.1f}s" for stage, seconds in stats['busy'].items())
+        print(f"\nPipeline peak queue depths: {peaks}; stage busy time: {busy_times}")
+        return stats['processed']
 
     def process_all_emails(self):
-        """Process all unread emails in the selected folder."""
+        """Process all unread emails in the selected folder. Returns how many were processed."""
+        if self.USE_KEYWORD_CLAIMS and self._uid_sync_enabled():
+            # Claims this machine still holds are from a run that died before finishing them
+            self.release_claims()
+
         # Get all messages
         self.emails = self._get_all_messages()
         
         if not self.emails:
             print("No new emails to process")
+            self._update_sync_state(self.emails)
+            return 0
+
+        start_time = time.perf_counter()
+        self._dir_index = {}  # Rebuilt each run in case folders were changed by hand in between
+        self.link_stats = {'downloaded': 0, 'bytes': 0, 'cached': 0, 'failed': []}
+        self._link_futures = {}
+        self.routes.clear()
+        pending = self.emails
+        if self.CLASSIFY_HEADERS:
+            self.routes.update(self._classify_messages(self.emails))
+            counts = {}
+            for route in self.routes.values():
+                counts[route] = counts.get(route, 0) + 1
+            print("Classified emails by headers: " + ', '.join(f"{count} {route}" for route, count in sorted(counts.items())))
+            # Skipped emails need no body, record them as processed straight away
+            pending = []
+            for email_id in self.emails:
+                if self.routes.get(email_id) == 'skip':
+                    self._mark_processed(email_id)
+                else:
+                    pending.append(email_id)
+
+        processed_count = len(self.emails) - len(pending)
+        if self.POOL_SIZE > 1 and len(pending) > self.FETCH_BATCH_SIZE:
+            processed_count += self._process_pooled(pending)
+        elif self.USE_PIPELINE:
+            processed_count += self._process_pipeline(self._batch_queue(pending), [self])
+        else:
+            processed_count += self._process_batches(self._batch_queue(pending))
+
+        elapsed = time.perf_counter() - start_time
+        rate = processed_count / elapsed if elapsed > 0 else 0.0
+        print(f"\nProcessed {processed_count} of {len(self.emails)} emails in {elapsed:.1f}s "
+              f"({rate:.1f} messages/sec, batch size {self.FETCH_BATCH_SIZE}, "
+              f"{self.fetched_bytes / 1024:.0f} KB fetched)")
+        links = self.link_stats
+        print(f"Delhivery links: {links['downloaded']} downloaded ({links['bytes'] / 1024:.0f} KB, "
+              f"{links['downloaded'] / elapsed if elapsed > 0 else 0.0:.1f} links/sec), "
+              f"{links['cached']} already downloaded, {len(links['failed'])} failed")
+        for href in links['failed']:
+            print(f"  Failed: {href}")
+
+        self._flush_done_marks()
+        self._update_sync_state(self.emails)
+        return processed_count
+
+    def watch(self):
+        """
+        Keep processing the selected folder as mail arrives, until interrupted.
+        The connection waits in IMAP IDLE between runs, so a new message is picked up within seconds
+        instead of on the next manual run. Dropped connections are reopened with a growing delay.
+        """
+        print(f"Watching {self.folder} for new emails (Ctrl+C to stop)")
+        delay = self.WATCH_RECONNECT_DELAY
+        try:
+            while True:
+                try:
+                    self.process_all_emails()
+                    self.state.commit()
+                    delay = self.WATCH_RECONNECT_DELAY
+                    # Search again after an IDLE timeout too, in case an announcement was missed
+                    self._wait_for_new_mail()
+                except (imaplib.IMAP4.abort, OSError) as e:
+                    print(f"IMAP connection lost: {e}. Reconnecting in {delay}s")
+                    time.sleep(delay)
+                    delay = min(delay * 2, self.WATCH_MAX_RECONNECT_DELAY)
+                    self._reconnect()
+        except KeyboardInterrupt:
+            print("\nStopped watching")
+
+    def _reconnect(self):
+        """Replace a dropped connection and reselect the watched folder"""
+        try:
+            self.imap.shutdown()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+        try:
+            self.imap = self._connect()
+            self.select_folder(self.folder)
+        except (imaplib.IMAP4.error, OSError) as e:
+            # The next pass through the watch loop fails on the dead connection and retries
+            print(f"Reconnect failed: {e}")
+
+    def _wait_for_new_mail(self):
+        """
+        Block until the server announces new messages (True) or IDLE_TIMEOUT passes (False).
+        Falls back to a NOOP poll every WATCH_POLL_INTERVAL seconds when IDLE isn't supported.
+        """
+        # Mail that arrived during the last run was announced in a FETCH or STORE response,
+        # which imaplib queued in untagged_responses where IDLE never sees it
+        if self.imap.response('EXISTS')[1][-1]:
+            print(f"New email arrived in {self.folder}")
+            return True
+
+        if 'IDLE' not in self.imap.capabilities:
+            time.sleep(self.WATCH_POLL_INTERVAL)
+            self.imap.noop()
+            return bool(self.imap.response('EXISTS')[1][-1])
+
+        # imaplib has no IDLE command before Python 3.14, so drive it over the raw connection
+        tag = self.imap._new_tag()
+        self.imap.send(tag + b' IDLE\r\n')
+        line = self.imap._get_line()
+        if not line.startswith(b'+'):
+            raise imaplib.IMAP4.error(f"IDLE rejected: {line!r}")
+
+        new_mail = False
+        deadline = time.monotonic() + self.IDLE_TIMEOUT
+        try:
+            while not new_mail:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if not self._response_buffered() and not select.select([self.imap.sock], [], [], remaining)[0]:
+                    continue
+                line = self.imap._get_line()
+                if re.match(rb'\* \d+ EXISTS', line):
+                    new_mail = True
+        finally:
+            self.imap.send(b'DONE\r\n')
+            while True:
+                line = self.imap._get_line()
+                if line.startswith(tag):
+                    break
+        if not line.startswith(tag + b' OK'):
+            raise imaplib.IMAP4.error(f"IDLE failed: {line!r}")
+        if new_mail:
+            print(f"New email arrived in {self.folder}")
+        return new_mail
+
+    def _response_buffered(self):
+        """
+        True if imaplib's reader or the TLS layer already holds server data, which select() can't see,
+        e.g. an EXISTS that arrived in the same packet as the line before it
+        """
+        timeout = self.imap.sock.gettimeout()
+        self.imap.sock.setblocking(False)
+        try:
+            return bool(self.imap.file.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            self.imap.sock.settimeout(timeout)
+
+    def replay(self, path):
+        """
+        Push the messages of an mbox file or a directory of .eml files through the same pipeline
+        as IMAP mail, without touching Gmail. Files are deduplicated against the same state as live
+        runs; replayed messages are not marked as processed since they have no IMAP UID.
+        """
+        archive = MailArchive(path)
+        message_ids = archive.message_ids()
+        print(f"Replaying {len(message_ids)} emails from {path}")
+        if not message_ids:
             return
 
-        for email_id in self.emails:
-            try:
-                email_message = self.fetch_message(email_id)
-                print(f"\nProcessing email: {email_message['subject']}")
-                
-                # Download attachments
-                self.download_attachments(email_message)
-                
-                # Process email body for Download Invoice button
-                self.process_email_body(email_message)
-                
-                # Mark this email as processed
-                self.processed_ids.add(email_id)
-                
-            except Exception as e:
-                print(f"Error processing email {email_id}: {e}")
+        start_time = time.perf_counter()
+        self._dir_index = {}
+        self.link_stats = {'downloaded': 0, 'bytes': 0, 'cached': 0, 'failed': []}
+        self._link_futures = {}
+        processed_count = self._process_pipeline(self._batch_queue(message_ids), [archive], mark_processed=False)
+
+        elapsed = time.perf_counter() - start_time
+        rate = processed_count / elapsed if elapsed > 0 else 0.0
+        print(f"\nReplayed {processed_count} of {len(message_ids)} emails in {elapsed:.1f}s "
+              f"({rate:.1f} messages/sec, {archive.fetched_bytes / 1024:.0f} KB read)")
+        links = self.link_stats
+        print(f"Delhivery links: {links['downloaded']} downloaded, {links['cached']} already downloaded, "
+              f"{len(links['failed'])} failed")
+        for href in links['failed']:
+            print(f"  Failed: {href}")
 
 
 if __name__ == "__main__":
     try:
+        # Replay a local mbox file or .eml directory with --replay PATH instead of reading Gmail
+        replay_path = sys.argv[sys.argv.index('--replay') + 1] if '--replay' in sys.argv[1:-1] else None
+
         # Create mailbox instance
-        mailbox = MailBox()
+        mailbox = MailBox(connect=replay_path is None)
         
-        # Process emails and download attachments
-        mailbox.process_all_emails()
+        # Process emails and download attachments, or keep doing so as they arrive with --watch
+        if replay_path:
+            mailbox.replay(replay_path)
+        elif '--release-claims' in sys.argv[1:]:
+            # Hand the emails a retired machine had claimed back to the others
+            mailbox.release_claims(all_hosts=True)
+        elif '--watch' in sys.argv[1:]:
+            mailbox.watch()
+        else:
+            mailbox.process_all_emails()
         
-        # Save processed email IDs and downloaded files before exiting
-        mailbox._save_processed_ids()
-        mailbox._save_downloaded_files()
+        # Save processed email IDs, downloaded files and sync state before exiting
+        mailbox.save_state()
         
         print("Script completed successfully")
         
@@ -3,8 +3,48 @@ import pandas as pd
 from tkinter import Tk, filedialog, messagebox
 import glob
 import datetime
-from openpyxl import load_workbook
-from openpyxl.styles import NamedStyle, Font, PatternFill
+import codecs
+import hashlib
+import concurrent.futures
+import json
+import multiprocessing
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import NamedStyle, Font, PatternFill, Border, Side, Alignment
+
+try:
+    import pyarrow  # noqa: F401  # Lets pandas write the parsed CSV cache as parquet
+    CSV_CACHE_FORMAT = 'parquet'
+except ImportError:
+    CSV_CACHE_FORMAT = 'pickle'
+
+# Columns kept from each Delhivery CSV
+REQUIRED_COLUMNS = [
+    'Invoice Number(s)', 'Pickup Date', 'Delivered Date', 'Total Amount',
+    'Consignee Name', 'LRN', 'Origin City', 'Destination City'
+]
+# Columns left empty for users to fill in Sheet1
+MANUAL_COLUMNS = [
+    'Vouched By', 'LR Vouching Date', 'Invoice Vouching Date', 'LR Query', 'Invoice Query',
+    'LR Loss Value', 'Freight Status', 'LR Status', 'Invoice Status'
+]
+CSV_READ_WORKERS = min(8, os.cpu_count() or 1)  # Processes reading CSV files in parallel, 1 reads them one by one
+PARALLEL_MIN_FILES = 8  # With fewer files, starting worker processes costs more than it saves
+ENCODING_SAMPLE_BYTES = 64 * 1024  # Bytes read from the start of a CSV to detect its encoding
+ENCODING_CACHE_FILE = 'csv_encodings.json'  # Detected encodings by file path, size and modification time
+FALLBACK_ENCODING = 'latin1'  # Decodes any byte, used when a file is not UTF-8
+USE_CSV_CACHE = True  # Keep each parsed and normalized CSV in CSV_CACHE_DIR so unchanged files are not parsed again
+CSV_CACHE_DIR = 'csv_cache'
+CSV_CACHE_VERSION = 1  # Bump when read_csv_file shapes frames differently, to ignore older cache entries
+CSV_CACHE_INDEX = 'index.json'  # In CSV_CACHE_DIR, the source CSV of each cache entry so stale ones can be pruned
+EXCEL_WRITE_CHUNK_ROWS = 10000  # Rows converted and streamed to the workbook at a time
+EXCEL_DATETIME_FORMAT = 'YYYY-MM-DD HH:MM:SS'  # Same as pandas' to_excel
+MANIFEST_SUFFIX = '.manifest.json'  # Saved beside a consolidated workbook, lists the CSVs already in it
+BOM_ENCODINGS = [
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
 
 def select_folder():
     """Open a dialog for user to select a folder"""
@@ -71,63 +111,261 @@ def create_sheet2_template():
     ]
     return pd.DataFrame(columns=columns)
 
-def combine_csv_files(files, existing_df=None):
-    """Combine multiple CSV files into a single DataFrame"""
-    if not files:
-        raise ValueError("No CSV files found starting with 'combined_'")
+def load_encoding_cache():
+    """Load the encodings detected on earlier runs, or an empty cache"""
+    try:
+        with open(ENCODING_CACHE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_encoding_cache(cache):
+    try:
+        with open(ENCODING_CACHE_FILE, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, indent=1)
+    except OSError as e:
+        print(f"Warning: Could not save encoding cache: {e}")
+
+def file_fingerprint(file):
+    """Key identifying this version of a file: absolute path, size and modification time"""
+    stat = os.stat(file)
+    return f"{os.path.abspath(file)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+def detect_encoding(file, cache=None):
+    """
+    Detect a CSV's encoding from its byte order mark, or else from whether the first
+    ENCODING_SAMPLE_BYTES decode as UTF-8. Results are stored in cache by file fingerprint,
+    so an unchanged file is not sampled again.
+    """
+    try:
+        key = file_fingerprint(file)
+    except OSError:
+        return 'utf-8'  # Let the read itself report the problem
+    if cache is not None and key in cache:
+        return cache[key]
     
-    # List to store all dataframes
-    dfs = []
+    try:
+        with open(file, 'rb') as f:
+            sample = f.read(ENCODING_SAMPLE_BYTES)
+    except OSError:
+        return 'utf-8'
     
-    # Required columns
-    required_columns = [
-        'Invoice Number(s)', 'Pickup Date', 'Delivered Date', 'Total Amount',
-        'Consignee Name', 'LRN', 'Origin City', 'Destination City'
-    ]
+    encoding = next((name for bom, name in BOM_ENCODINGS if sample.startswith(bom)), None)
+    if encoding is None:
+        try:
+            # A multi-byte character may be cut off at the end of the sample
+            codecs.getincrementaldecoder('utf-8')().decode(sample, final=len(sample) < ENCODING_SAMPLE_BYTES)
+            encoding = 'utf-8'
+        except UnicodeDecodeError:
+            encoding = FALLBACK_ENCODING
     
-    # Read each CSV file
-    for file in files:
+    if cache is not None:
+        cache[key] = encoding
+    return encoding
+
+def read_csv_with_encoding(file, encoding, **kwargs):
+    """
+    Parse a CSV with a detected encoding. Only if a file detected as UTF-8 has
+    invalid bytes past the sample is it parsed a second time with FALLBACK_ENCODING.
+    
+    Returns:
+        tuple: (DataFrame, encoding actually used)
+    """
+    try:
+        return pd.read_csv(file, encoding=encoding, **kwargs), encoding
+    except UnicodeDecodeError:
+        if encoding == FALLBACK_ENCODING:
+            raise
+        return pd.read_csv(file, encoding=FALLBACK_ENCODING, **kwargs), FALLBACK_ENCODING
+
+def csv_cache_path(file, format=CSV_CACHE_FORMAT):
+    """Cache file for the current version of a CSV; the path is part of the key as frames record it"""
+    key = hashlib.sha1(f"{CSV_CACHE_VERSION}|{file}|{file_fingerprint(file)}".encode('utf-8')).hexdigest()
+    return os.path.join(CSV_CACHE_DIR, key + ('.parquet' if format == 'parquet' else '.pkl'))
+
+def load_cached_frame(file):
+    """Return the cached frame for this version of file, or None"""
+    try:
+        for format in dict.fromkeys((CSV_CACHE_FORMAT, 'pickle')):
+            path = csv_cache_path(file, format)
+            if os.path.exists(path):
+                return pd.read_parquet(path) if format == 'parquet' else pd.read_pickle(path)
+    except Exception:
+        pass  # A damaged or unreadable entry is rebuilt from the CSV
+    return None
+
+def save_cached_frame(file, df):
+    try:
+        os.makedirs(CSV_CACHE_DIR, exist_ok=True)
+        path = csv_cache_path(file)
+        temp_path = f"{path}.{os.getpid()}.tmp"
         try:
-            print(f"Reading file: {os.path.basename(file)}")
+            if CSV_CACHE_FORMAT == 'parquet':
+                df.to_parquet(temp_path, index=False)
+            else:
+                df.to_pickle(temp_path)
+        except (ValueError, TypeError, ImportError):
+            if CSV_CACHE_FORMAT == 'pickle':
+                raise
+            # Columns parquet can't store, e.g. mixed types, are kept as a pickle
+            path = csv_cache_path(file, 'pickle')
+            df.to_pickle(temp_path)
+        os.replace(temp_path, path)
+    except Exception:
+        pass  # The cache only saves time; the frame itself was read fine
+
+def prune_csv_cache(files):
+    """
+    Record which CSV each of files was cached from in the cache index, then delete the entries
+    that can't be used again: their CSV was deleted or has changed, or they are from another
+    CSV_CACHE_VERSION or were never indexed.
+    """
+    if not os.path.isdir(CSV_CACHE_DIR):
+        return
+    index_path = os.path.join(CSV_CACHE_DIR, CSV_CACHE_INDEX)
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    
+    for file in files:
+        for format in dict.fromkeys((CSV_CACHE_FORMAT, 'pickle')):
             try:
-                df = pd.read_csv(file, encoding='utf-8')
-            except UnicodeDecodeError:
-                df = pd.read_csv(file, encoding='latin1')
-            
-            # Keep only required columns if they exist
-            available_columns = [col for col in required_columns if col in df.columns]
-            if not available_columns:
-                print(f"Warning: No required columns found in {file}")
+                path = csv_cache_path(file, format)
+            except OSError:
                 continue
-                
-            df = df[available_columns]
-            
-            # Add source information
-            df['Source_File'] = os.path.basename(file)
-            df['Source_Folder'] = os.path.dirname(file)
-            
-            # Add Transporter Name column
-            df['Transporter Name'] = 'Delhivery Limited'
-            
-            # Convert Pickup Date to datetime and extract month
-            if 'Pickup Date' in df.columns:
-                df['Pickup Date'] = pd.to_datetime(df['Pickup Date'], errors='coerce')
-                df['Invoice Month'] = df['Pickup Date'].dt.strftime('%B %Y')
-            
-            # Add new required columns with empty values
-            df['Vouched By'] = ''
-            df['LR Vouching Date'] = ''
-            df['Invoice Vouching Date'] = ''
-            df['LR Query'] = ''
-            df['Invoice Query'] = ''
-            df['LR Loss Value'] = ''
-            df['Freight Status'] =''
-            df['LR Status'] =''
-            df['Invoice Status'] =''
+            if os.path.exists(path):
+                index[os.path.basename(path)] = file
+    
+    live = {}
+    for name, file in index.items():
+        try:
+            if os.path.basename(csv_cache_path(file, 'parquet' if name.endswith('.parquet') else 'pickle')) == name:
+                live[name] = file
+        except OSError:
+            pass  # The CSV no longer exists
+    removed = 0
+    for name in os.listdir(CSV_CACHE_DIR):
+        if name.endswith(('.parquet', '.pkl')) and name not in live:
+            try:
+                os.remove(os.path.join(CSV_CACHE_DIR, name))
+                removed += 1
+            except OSError:
+                pass
+    if removed:
+        print(f"Removed {removed} stale entries from {CSV_CACHE_DIR}")
+    
+    try:
+        with open(index_path, 'w', encoding='utf-8') as f:
+            json.dump(live, f, indent=1)
+    except OSError as e:
+        print(f"Warning: Could not save CSV cache index: {e}")
+
+def read_csv_file(file, encoding='utf-8'):
+    """
+    Read one Delhivery CSV and shape it for the consolidated sheet.
+    Runs in a worker process in parallel mode, so problems are returned rather than printed.
+    With USE_CSV_CACHE, a frame cached for the same version of the file is returned instead.
+    
+    Returns:
+        tuple: (DataFrame or None if the file was skipped, warning/error message or None,
+                encoding the file was read with)
+    """
+    try:
+        if USE_CSV_CACHE:
+            df = load_cached_frame(file)
+            if df is not None:
+                return df, None, encoding
+        
+        # Only parse the required columns
+        df, encoding = read_csv_with_encoding(file, encoding, usecols=lambda col: col in REQUIRED_COLUMNS)
+        
+        # Keep only required columns if they exist
+        available_columns = [col for col in REQUIRED_COLUMNS if col in df.columns]
+        if not available_columns:
+            return None, f"Warning: No required columns found in {file}", encoding
             
-            dfs.append(df)
-        except Exception as e:
-            print(f"Error reading {file}: {e}")
+        df = df[available_columns]
+        
+        # Add source information
+        df['Source_File'] = os.path.basename(file)
+        df['Source_Folder'] = os.path.dirname(file)
+        
+        # Add Transporter Name column
+        df['Transporter Name'] = 'Delhivery Limited'
+        
+        # Convert Pickup Date to datetime and extract month
+        if 'Pickup Date' in df.columns:
+            df['Pickup Date'] = pd.to_datetime(df['Pickup Date'], errors='coerce')
+            df['Invoice Month'] = df['Pickup Date'].dt.strftime('%B %Y')
+        
+        # Add new required columns with empty values
+        for column in MANUAL_COLUMNS:
+            df[column] = ''
+        
+        if USE_CSV_CACHE:
+            save_cached_frame(file, df)
+        return df, None, encoding
+    except Exception as e:
+        return None, f"Error reading {file}: {e}", encoding
+
+def read_csv_files(files, workers=None):
+    """
+    Read CSV files with read_csv_file, in a process pool when there are enough of them.
+    Frames are returned in the order of files, so the combined data is the same either way.
+    Encodings are detected here, once per file version, and remembered in ENCODING_CACHE_FILE.
+    """
+    cache = load_encoding_cache()
+    encodings = [detect_encoding(file, cache) for file in files]
+    results = None
+    
+    workers = CSV_READ_WORKERS if workers is None else workers
+    if workers > 1 and len(files) >= PARALLEL_MIN_FILES:
+        workers = min(workers, len(files))
+        print(f"Reading {len(files)} files with {workers} worker processes...")
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(read_csv_file, files, encodings, chunksize=4))
+        except (OSError, concurrent.futures.process.BrokenProcessPool) as e:
+            print(f"Parallel reading failed ({e}), reading files one by one")
+            results = None
+    
+    dfs = []
+    for i, file in enumerate(files):
+        if results is None:
+            print(f"Reading file: {os.path.basename(file)}")
+            df, message, encoding = read_csv_file(file, encodings[i])
+        else:
+            print(f"Read file: {os.path.basename(file)}")
+            df, message, encoding = results[i]
+        if message:
+            print(message)
+        if encoding != encodings[i]:
+            # The sample looked like UTF-8 but the rest of the file was not
+            try:
+                cache[file_fingerprint(file)] = encoding
+            except OSError:
+                pass
+        dfs.append(df)
+    
+    save_encoding_cache(cache)
+    if USE_CSV_CACHE:
+        prune_csv_cache(files)
+    return dfs
+
+def combine_csv_files(files, existing_df=None, workers=None):
+    """
+    Combine multiple CSV files into a single DataFrame
+    
+    Args:
+        workers: Number of processes reading the files (defaults to CSV_READ_WORKERS, 1 for sequential)
+    """
+    if not files:
+        raise ValueError("No CSV files found starting with 'combined_'")
+    
+    # Read each CSV file
+    dfs = [df for df in read_csv_files(files, workers) if df is not None]
     
     if not dfs:
         raise ValueError("No data could be read from the CSV files")
@@ -161,6 +399,175 @@ def combine_csv_files(files, existing_df=None):
     
     return new_data_df
 
+def iter_frame_chunks(df, chunk_rows=EXCEL_WRITE_CHUNK_ROWS):
+    """Yield consecutive row slices of df"""
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start:start + chunk_rows]
+
+def write_sheet_rows(wb, sheet_name, columns, chunks):
+    """Append a header row and the rows of each DataFrame chunk to a new write-only sheet"""
+    ws = wb.create_sheet(sheet_name)
+    # The bold, bordered, centred header to_excel wrote before pandas 3
+    thin = Side(style='thin')
+    header = []
+    for column in columns:
+        cell = WriteOnlyCell(ws, value=column)
+        cell.font = Font(bold=True)
+        cell.border = Border(left=thin, right=thin, top=thin, bottom=thin)
+        cell.alignment = Alignment(horizontal='center', vertical='top')
+        header.append(cell)
+    ws.append(header)
+    for chunk in chunks:
+        datetime_columns = [i for i, dtype in enumerate(chunk.dtypes) if pd.api.types.is_datetime64_any_dtype(dtype)]
+        # Plain Python values with empty cells for NaN/NaT and '', as to_excel writes them
+        values = chunk.astype(object).where(chunk.notna() & chunk.ne(''), None)
+        for row in values.itertuples(index=False, name=None):
+            if datetime_columns:
+                row = list(row)
+                for i in datetime_columns:
+                    if row[i] is not None:
+                        cell = WriteOnlyCell(ws, value=row[i].to_pydatetime())
+                        cell.number_format = EXCEL_DATETIME_FORMAT
+                        row[i] = cell
+            ws.append(row)
+
+def write_consolidated_workbook(output_file, sheet1_chunks, sheet1_columns, sheet2_df):
+    """
+    Stream the consolidated workbook to output_file with openpyxl's write-only mode.
+    Rows are serialized as each chunk arrives instead of building every cell in memory,
+    so the writer's memory use does not grow with the number of rows.
+    
+    Args:
+        sheet1_chunks: Iterable of DataFrames with the Sheet1 rows, e.g. iter_frame_chunks(df)
+        sheet1_columns: Sheet1 header
+        sheet2_df: Sheet2 contents
+    """
+    wb = Workbook(write_only=True)
+    write_sheet_rows(wb, 'Sheet1', sheet1_columns, sheet1_chunks)
+    write_sheet_rows(wb, 'Sheet2', sheet2_df.columns, iter_frame_chunks(sheet2_df))
+    wb.save(output_file)
+
+def source_keys(df):
+    """Source_File|Source_Folder key of each row"""
+    return df['Source_File'].astype(str) + '|' + df['Source_Folder'].astype(str)
+
+def lrn_keys(df):
+    """LRN of each row as text, so numbers read from Excel and from CSV compare equal"""
+    return df['LRN'].astype(str).str.strip().str.replace(r'\.0$', '', regex=True)
+
+def restore_replaced_rows(combined_df, previous_rows):
+    """
+    Carry what users entered in the MANUAL_COLUMNS of rows from changed CSVs over to the
+    re-read rows, matched by source file and LRN. Files that could not be re-read keep
+    their previous rows.
+    
+    Args:
+        combined_df: Consolidated data after the changed CSVs were read again
+        previous_rows: Their rows as they were in the existing workbook
+    """
+    reread = source_keys(previous_rows).isin(set(source_keys(combined_df)))
+    replaced, kept = previous_rows[reread], previous_rows[~reread]
+    
+    if not replaced.empty and 'LRN' in replaced.columns and 'LRN' in combined_df.columns:
+        previous_keys = source_keys(replaced) + '|' + lrn_keys(replaced)
+        combined_keys = source_keys(combined_df) + '|' + lrn_keys(combined_df)
+        carried = 0
+        for column in MANUAL_COLUMNS:
+            if column not in replaced.columns or column not in combined_df.columns:
+                continue
+            values = replaced[column]
+            entered = values.notna() & (values.astype(str) != '')
+            lookup = pd.Series(values[entered].values, index=previous_keys[entered].values)
+            lookup = lookup[~lookup.index.duplicated()]
+            mapped = combined_keys.map(lookup)
+            combined_df[column] = combined_df[column].astype(object).where(mapped.isna(), mapped)
+            carried += int(mapped.notna().sum())
+        print(f"Carried over {carried} manually entered values from replaced rows")
+    
+    if not kept.empty:
+        print(f"Keeping {len(kept)} previous rows of changed files that could not be read again")
+        combined_df = pd.concat([combined_df, kept], ignore_index=True)
+        combined_df['Duplicate LR'] = combined_df.duplicated(subset=['LRN'], keep=False).map({True: 'Yes', False: 'No'})
+    return combined_df
+
+def manifest_path(output_file):
+    """Path of the ingested-file manifest kept beside a consolidated workbook"""
+    return os.path.splitext(output_file)[0] + MANIFEST_SUFFIX
+
+def load_manifest(output_file):
+    """
+    Load the manifest of CSVs already consolidated into output_file.
+    
+    Returns:
+        dict or None: {absolute path: {'size', 'mtime_ns', 'sha256'}}, None if there is no manifest yet
+    """
+    try:
+        with open(manifest_path(output_file), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not read manifest, all CSV files will be checked: {e}")
+        return None
+
+def save_manifest(output_file, manifest):
+    try:
+        with open(manifest_path(output_file), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=1)
+    except OSError as e:
+        print(f"Warning: Could not save manifest: {e}")
+
+def file_sha256(file):
+    sha256 = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def manifest_entry(file, sha256=None):
+    stat = os.stat(file)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256 or file_sha256(file)}
+
+def select_files_to_ingest(files, manifest, existing_keys=()):
+    """
+    Compare files against the manifest of a consolidated workbook.
+    Files with the recorded size and mtime are skipped without being read; files whose
+    size or mtime changed are hashed and skipped if their content did not.
+    Without a manifest (a workbook consolidated before manifests existed), files whose
+    Source_File|Source_Folder key is already in the workbook count as ingested.
+    Updates manifest in place for files found unchanged, and drops the entries of CSVs that
+    no longer exist; their rows stay in the workbook, and combine_csv_files skips them by
+    Source_File|Source_Folder key should the file come back.
+    
+    Returns:
+        tuple: (new files, changed files) to be read
+    """
+    new_files, changed_files = [], []
+    for file in files:
+        key = os.path.abspath(file)
+        try:
+            stat = os.stat(file)
+            entry = manifest.get(key)
+            if entry is None:
+                if f"{os.path.basename(file)}|{os.path.dirname(file)}" in existing_keys:
+                    manifest[key] = manifest_entry(file)
+                else:
+                    new_files.append(file)
+            elif entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+                continue
+            else:
+                sha256 = file_sha256(file)
+                if sha256 == entry['sha256']:
+                    manifest[key] = manifest_entry(file, sha256)
+                else:
+                    changed_files.append(file)
+        except OSError as e:
+            print(f"Warning: Could not check {file}: {e}")
+            new_files.append(file)  # Let the read report it
+    for key in [key for key in manifest if not os.path.exists(key)]:
+        del manifest[key]
+    return new_files, changed_files
+
 def fill_invoice_dates(consolidated_file):
     """
     Fill the Invoice Date column in Sheet2 based on matching Invoice Numbers 
@@ -239,20 +646,17 @@ def fill_invoice_dates(consolidated_file):
                     return 0
             else:  # CSV file
                 try:
-                    # Try multiple encodings to handle potential encoding issues
-                    encodings_to_try = ['utf-8', 'latin1', 'cp1252', 'ISO-8859-1']
-                    
-                    for encoding in encodings_to_try:
-                        try:
-                            print(f"Trying to read CSV with {encoding} encoding...")
-                            source_df = pd.read_csv(source_file, encoding=encoding)
-                            break  # If successful, break the loop
-                        except UnicodeDecodeError:
-                            if encoding == encodings_to_try[-1]:  # Last encoding to try
-                                raise  # Re-raise the exception if all encodings fail
-                            continue  # Try the next encoding
-                        except Exception as e:
-                            raise Exception(f"Error reading CSV: {str(e)}")
+                    # Detect the encoding first so the file is parsed once
+                    cache = load_encoding_cache()
+                    encoding = detect_encoding(source_file, cache)
+                    print(f"Reading CSV with {encoding} encoding...")
+                    try:
+                        source_df, used_encoding = read_csv_with_encoding(source_file, encoding)
+                    except Exception as e:
+                        raise Exception(f"Error reading CSV: {str(e)}")
+                    if used_encoding != encoding:
+                        cache[file_fingerprint(source_file)] = used_encoding
+                    save_encoding_cache(cache)
                     
                     # Check if required columns exist
                     invoice_num_cols = [col for col in source_df.columns if 'invoice number' in col.lower() or 'invoice no' in col.lower()]
@@ -453,6 +857,8 @@ def main():
         append_to_existing = ask_user_preference()
         existing_df = None
         output_file = None
+        manifest = {}
+        previous_rows = None
         
         if append_to_existing:
             print("\nPlease select the existing consolidated file to append to...")
@@ -474,6 +880,30 @@ def main():
             except Exception as e:
                 print(f"Error reading existing file: {e}")
                 return
+            
+            # Only read CSVs that are new or changed since they were consolidated
+            manifest = load_manifest(output_file)
+            existing_keys = ()
+            if manifest is None:
+                manifest = {}
+                existing_keys = set(source_keys(existing_df))
+            new_files, changed_files = select_files_to_ingest(csv_files, manifest, existing_keys)
+            print(f"\n{len(new_files)} new and {len(changed_files)} changed CSV files, "
+                  f"{len(csv_files) - len(new_files) - len(changed_files)} already consolidated")
+            if not new_files and not changed_files:
+                save_manifest(output_file, manifest)
+                print("Nothing new to consolidate.")
+                return
+            
+            if changed_files:
+                # Replace the rows of changed files rather than keeping the stale ones;
+                # restore_replaced_rows brings back what users entered on them
+                changed_keys = {f"{os.path.basename(file)}|{os.path.dirname(file)}" for file in changed_files}
+                stale = source_keys(existing_df).isin(changed_keys)
+                print(f"Replacing {stale.sum()} rows from changed files")
+                previous_rows = existing_df[stale]
+                existing_df = existing_df[~stale].reset_index(drop=True)
+            csv_files = new_files + changed_files
         else:
             # Create consolidated folder and new output file path
             consolidated_folder = create_consolidated_folder(folder_path)
@@ -482,12 +912,28 @@ def main():
             sheet2_df = create_sheet2_template()
         
         # Combine CSV files
-        combined_data = combine_csv_files(csv_files, existing_df)
+        try:
+            combined_data = combine_csv_files(csv_files, existing_df)
+        except ValueError as e:
+            if existing_df is None:
+                raise
+            # Only files without usable rows were new; the workbook is already up to date
+            save_manifest(output_file, manifest)
+            print(f"Nothing new to consolidate: {e}")
+            return
+        # Files whose rows were read this run, before any rows of unreadable changed files are restored
+        ingested_files = set(source_keys(combined_data))
+        if previous_rows is not None:
+            combined_data = restore_replaced_rows(combined_data, previous_rows)
         
         # Save combined data as Excel with two sheets
-        with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
-            combined_data.to_excel(writer, sheet_name='Sheet1', index=False)
-            sheet2_df.to_excel(writer, sheet_name='Sheet2', index=False)
+        write_consolidated_workbook(output_file, iter_frame_chunks(combined_data), combined_data.columns, sheet2_df)
+        
+        # Record the ingested files only once their rows are saved
+        for file in csv_files:
+            if f"{os.path.basename(file)}|{os.path.dirname(file)}" in ingested_files:
+                manifest[os.path.abspath(file)] = manifest_entry(file)
+        save_manifest(output_file, manifest)
         
         print(f"\nSuccessfully processed files!")
         print(f"Output saved to: {output_file}")
@@ -514,4 +960,6 @@ def main():
         print(f"An error occurred: {e}")
 
 if __name__ == "__main__":
+    # Lets the CSV reader's worker processes start from the frozen Windows executable
+    multiprocessing.freeze_support()
     main() 
\ No newline at end of file
@@ -0,0 +1,261 @@
+import os
+import pickle
+import sqlite3
+import threading
+from collections.abc import MutableMapping, MutableSet
+
+
+class MailStateStore:
+    """
+    WAL-mode SQLite store for the attachment downloader's state: processed messages,
+    content hashes of downloaded files, the per-folder UID sync watermark and cached invoice links.
+    The tables are exposed as set/dict-like views so MailBox can use them like the old pickles.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()  # The connection is shared by the IMAP and link worker threads
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self._create_tables()
+
+        self.processed_ids = ProcessedIds(self)
+        self.downloaded_files = DownloadedFiles(self)
+        self.sync_state = SyncState(self)
+        self.link_cache = LinkCache(self)
+
+    def _create_tables(self):
+        with self._lock:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS processed_uids (
+                    folder TEXT NOT NULL,
+                    uidvalidity INTEGER NOT NULL,
+                    uid INTEGER NOT NULL,
+                    PRIMARY KEY (folder, uidvalidity, uid)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS processed_sequence_ids (
+                    email_id BLOB PRIMARY KEY
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS content_hashes (
+                    content_hash TEXT PRIMARY KEY,
+                    filename TEXT NOT NULL
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    folder TEXT PRIMARY KEY,
+                    uidvalidity INTEGER NOT NULL,
+                    last_uid INTEGER NOT NULL,
+                    last_sync_date TEXT
+                );
+                CREATE TABLE IF NOT EXISTS link_cache (
+                    href TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT,
+                    content_hash TEXT,
+                    size INTEGER
+                );
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+            """)
+            # Databases created before the date watermark lack its column
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(sync_state)")]
+            if 'last_sync_date' not in columns:
+                self.conn.execute("ALTER TABLE sync_state ADD COLUMN last_sync_date TEXT")
+            self.conn.commit()
+
+    def execute(self, sql, params=()):
+        """Run a write statement; it becomes durable on the next commit()"""
+        with self._lock:
+            return self.conn.execute(sql, params).rowcount
+
+    def query(self, sql, params=()):
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def commit(self):
+        with self._lock:
+            self.conn.commit()
+
+    def close(self):
+        with self._lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def migrate_pickles(self, processed_ids_file, downloaded_files_file, sync_state_file=None):
+        """
+        One-time import of the old pickle state files. Each imported pickle is renamed
+        to <name>.migrated so it is never imported twice.
+        """
+        if self.query("SELECT 1 FROM meta WHERE key = 'pickles_migrated'"):
+            return
+
+        for path, target in ((processed_ids_file, self.processed_ids),
+                             (downloaded_files_file, self.downloaded_files),
+                             (sync_state_file, self.sync_state)):
+            if not path or not os.path.exists(path):
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    data = pickle.load(f)
+            except EOFError:
+                data = None
+            if isinstance(target, ProcessedIds):
+                for key in data or ():
+                    target.add(key)
+            elif data:
+                for key, value in data.items():
+                    target[key] = value
+            print(f"Migrated {len(data or ())} records from {path}")
+            os.replace(path, path + '.migrated')
+
+        self.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('pickles_migrated', '1')")
+        self.commit()
+
+
+class ProcessedIds(MutableSet):
+    """
+    Set of processed messages. Keys are (folder, uidvalidity, uid) tuples in UID sync mode
+    and raw sequence number bytes otherwise.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __contains__(self, key):
+        if isinstance(key, tuple):
+            return bool(self.store.query(
+                "SELECT 1 FROM processed_uids WHERE folder = ? AND uidvalidity = ? AND uid = ?", key))
+        return bool(self.store.query("SELECT 1 FROM processed_sequence_ids WHERE email_id = ?", (key,)))
+
+    def __iter__(self):
+        for row in self.store.query("SELECT folder, uidvalidity, uid FROM processed_uids"):
+            yield tuple(row)
+        for (email_id,) in self.store.query("SELECT email_id FROM processed_sequence_ids"):
+            yield bytes(email_id)
+
+    def __len__(self):
+        return (self.store.query("SELECT COUNT(*) FROM processed_uids")[0][0]
+                + self.store.query("SELECT COUNT(*) FROM processed_sequence_ids")[0][0])
+
+    def add(self, key):
+        if isinstance(key, tuple):
+            self.store.execute(
+                "INSERT OR IGNORE INTO processed_uids (folder, uidvalidity, uid) VALUES (?, ?, ?)", key)
+        else:
+            self.store.execute("INSERT OR IGNORE INTO processed_sequence_ids (email_id) VALUES (?)", (key,))
+
+    def discard(self, key):
+        if isinstance(key, tuple):
+            self.store.execute(
+                "DELETE FROM processed_uids WHERE folder = ? AND uidvalidity = ? AND uid = ?", key)
+        else:
+            self.store.execute("DELETE FROM processed_sequence_ids WHERE email_id = ?", (key,))
+
+    def discard_folder(self, folder):
+        """Forget every UID recorded for folder (its UIDVALIDITY changed)"""
+        self.store.execute("DELETE FROM processed_uids WHERE folder = ?", (folder,))
+
+    def discard_through(self, folder, uidvalidity, last_uid):
+        """Forget UIDs at or below last_uid, which the sync watermark already covers"""
+        self.store.execute("DELETE FROM processed_uids WHERE folder = ? AND uidvalidity = ? AND uid <= ?",
+                           (folder, uidvalidity, last_uid))
+
+
+class DownloadedFiles(MutableMapping):
+    """Mapping of content hash to the filename it was saved as"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, content_hash):
+        rows = self.store.query("SELECT filename FROM content_hashes WHERE content_hash = ?", (content_hash,))
+        if not rows:
+            raise KeyError(content_hash)
+        return rows[0][0]
+
+    def __setitem__(self, content_hash, filename):
+        self.store.execute("INSERT OR REPLACE INTO content_hashes (content_hash, filename) VALUES (?, ?)",
+                           (content_hash, filename))
+
+    def __delitem__(self, content_hash):
+        if not self.store.execute("DELETE FROM content_hashes WHERE content_hash = ?", (content_hash,)):
+            raise KeyError(content_hash)
+
+    def __contains__(self, content_hash):
+        return bool(self.store.query("SELECT 1 FROM content_hashes WHERE content_hash = ?", (content_hash,)))
+
+    def __iter__(self):
+        for (content_hash,) in self.store.query("SELECT content_hash FROM content_hashes"):
+            yield content_hash
+
+    def __len__(self):
+        return self.store.query("SELECT COUNT(*) FROM content_hashes")[0][0]
+
+
+class SyncState(MutableMapping):
+    """
+    Mapping of folder to {'uidvalidity': int, 'last_uid': int, 'last_sync_date': 'YYYY-MM-DD' or None};
+    assign a new dict to update a folder
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, folder):
+        rows = self.store.query("SELECT uidvalidity, last_uid, last_sync_date FROM sync_state WHERE folder = ?",
+                                (folder,))
+        if not rows:
+            raise KeyError(folder)
+        return {'uidvalidity': rows[0][0], 'last_uid': rows[0][1], 'last_sync_date': rows[0][2]}
+
+    def __setitem__(self, folder, state):
+        self.store.execute("INSERT OR REPLACE INTO sync_state (folder, uidvalidity, last_uid, last_sync_date) "
+                           "VALUES (?, ?, ?, ?)",
+                           (folder, state['uidvalidity'], state['last_uid'], state.get('last_sync_date')))
+
+    def __delitem__(self, folder):
+        if not self.store.execute("DELETE FROM sync_state WHERE folder = ?", (folder,)):
+            raise KeyError(folder)
+
+    def __iter__(self):
+        for (folder,) in self.store.query("SELECT folder FROM sync_state"):
+            yield folder
+
+    def __len__(self):
+        return self.store.query("SELECT COUNT(*) FROM sync_state")[0][0]
+
+
+class LinkCache(MutableMapping):
+    """
+    Mapping of invoice link href to {'etag', 'last_modified', 'content_hash', 'size'}.
+    content_hash is None while a download of the link is still partial.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, href):
+        rows = self.store.query("SELECT etag, last_modified, content_hash, size FROM link_cache WHERE href = ?", (href,))
+        if not rows:
+            raise KeyError(href)
+        etag, last_modified, content_hash, size = rows[0]
+        return {'etag': etag, 'last_modified': last_modified, 'content_hash': content_hash, 'size': size}
+
+    def __setitem__(self, href, entry):
+        self.store.execute("INSERT OR REPLACE INTO link_cache (href, etag, last_modified, content_hash, size) "
+                           "VALUES (?, ?, ?, ?, ?)",
+                           (href, entry.get('etag'), entry.get('last_modified'), entry.get('content_hash'),
+                            entry.get('size')))
+
+    def __delitem__(self, href):
+        if not self.store.execute("DELETE FROM link_cache WHERE href = ?", (href,)):
+            raise KeyError(href)
+
+    def __iter__(self):
+        for (href,) in self.store.query("SELECT href FROM link_cache"):
+            yield href
+
+    def __len__(self):
+        return self.store.query("SELECT COUNT(*) FROM link_cache")[0][0]
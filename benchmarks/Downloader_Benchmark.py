@@ -0,0 +1,161 @@
+"""
+Throughput benchmark for the Gmail attachment downloader.
+Builds a synthetic mailbox, serves it from a local IMAP stand-in with the Delhivery links on a
+local HTTP stand-in, runs MailBox.process_all_emails() in a scratch directory and reports
+messages/sec, bytes/sec, peak RSS and per-stage time.
+
+    python benchmarks/Downloader_Benchmark.py --bluedart 500 --delhivery 500 --save-baseline baseline.json
+    python benchmarks/Downloader_Benchmark.py --bluedart 500 --delhivery 500 --baseline baseline.json
+
+The script exits with status 1 when not every message was processed or an invoice link failed,
+and with --baseline also when messages/sec dropped by more than --tolerance.
+"""
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Attachment_Downloader_Gmail_Step1 import MailBox
+from Local_Http_Server import LocalHttpServer
+from Local_Imap_Server import LocalImapServer
+from Synthetic_Mailbox import generate_messages
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None if it can't be measured"""
+    try:
+        import resource
+    except ImportError:
+        # Windows: psutil reports the peak working set when it is installed
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_benchmark(args):
+    http = LocalHttpServer(file_size=args.link_size, latency=args.link_latency).start()
+    messages = generate_messages(bluedart=args.bluedart, delhivery=args.delhivery, zips=args.zips,
+                                 duplicates=args.duplicates, csv_rows=args.csv_rows, seed=args.seed,
+                                 link_base=http.base_url)
+    imap = LocalImapServer().start()
+    folder = imap.add_folder('Automation')
+    for raw in messages:
+        folder.append(raw)
+
+    class BenchmarkMailBox(MailBox):
+        SMTP_SERVER = '127.0.0.1'
+        SMTP_PORT = imap.port
+        USE_SSL = False
+        USER = 'benchmark'
+        PASSWORD = 'benchmark'
+        POOL_SIZE = args.pool_size
+        FETCH_BATCH_SIZE = args.batch_size
+        USE_PIPELINE = not args.no_pipeline
+        USE_PARTIAL_FETCH = not args.no_partial_fetch
+
+    work_dir = tempfile.mkdtemp(prefix='downloader_benchmark_')
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        # The downloader logs every message; keep that out of the timings and the report
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull if not args.verbose else sys.stdout):
+            mailbox = BenchmarkMailBox()
+            start = time.perf_counter()
+            processed = mailbox.process_all_emails()
+            elapsed = time.perf_counter() - start
+            mailbox.__exit__(None, None, None)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        imap.stop()
+        http.stop()
+
+    transferred = mailbox.fetched_bytes + mailbox.link_stats['bytes']
+    pipeline_stats = getattr(mailbox, 'pipeline_stats', None) if not args.no_pipeline else None
+    return {
+        'messages': len(messages),
+        'processed': processed,
+        'seconds': elapsed,
+        'messages_per_sec': processed / elapsed if elapsed > 0 else 0.0,
+        'bytes_per_sec': transferred / elapsed if elapsed > 0 else 0.0,
+        'imap_bytes': mailbox.fetched_bytes,
+        'link_bytes': mailbox.link_stats['bytes'],
+        'links_downloaded': mailbox.link_stats['downloaded'],
+        'links_cached': mailbox.link_stats['cached'],
+        'links_failed': len(mailbox.link_stats['failed']),
+        'peak_rss_mb': peak_rss_mb(),
+        'stage_seconds': pipeline_stats['busy'] if pipeline_stats else None,
+    }
+
+
+def print_report(result):
+    print(f"Messages:       {result['processed']} of {result['messages']} in {result['seconds']:.2f}s "
+          f"({result['messages_per_sec']:.1f} messages/sec)")
+    print(f"Throughput:     {result['bytes_per_sec'] / 1024:.0f} KB/sec "
+          f"({result['imap_bytes'] / 1024:.0f} KB IMAP, {result['link_bytes'] / 1024:.0f} KB links)")
+    print(f"Links:          {result['links_downloaded']} downloaded, {result['links_cached']} already downloaded, "
+          f"{result['links_failed']} failed")
+    peak = result['peak_rss_mb']
+    print(f"Peak RSS:       {f'{peak:.1f} MB' if peak is not None else 'n/a (install psutil on Windows)'}")
+    if result['stage_seconds']:
+        stages = ', '.join(f"{stage} {seconds:.2f}s" for stage, seconds in result['stage_seconds'].items())
+        print(f"Stage time:     {stages}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bluedart', type=int, default=200, help='BlueDart mails with a CSV attachment')
+    parser.add_argument('--delhivery', type=int, default=200, help='Delhivery mails with an invoice link')
+    parser.add_argument('--zips', type=int, default=40, help='BlueDart mails with a ZIP of 3 CSVs')
+    parser.add_argument('--duplicates', type=int, default=40, help='resends of earlier BlueDart attachments')
+    parser.add_argument('--csv-rows', type=int, default=200, help='rows per generated CSV')
+    parser.add_argument('--link-size', type=int, default=20 * 1024, help='bytes per Delhivery invoice')
+    parser.add_argument('--link-latency', type=float, default=0.02, help='seconds of simulated latency per link')
+    parser.add_argument('--pool-size', type=int, default=MailBox.POOL_SIZE)
+    parser.add_argument('--batch-size', type=int, default=MailBox.FETCH_BATCH_SIZE)
+    parser.add_argument('--no-pipeline', action='store_true', help='use the sequential batch loop')
+    parser.add_argument('--no-partial-fetch', action='store_true', help='fetch whole messages')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help="show the downloader's own output")
+    parser.add_argument('--save-baseline', metavar='FILE', help='write the results as JSON')
+    parser.add_argument('--baseline', metavar='FILE', help='compare against results saved with --save-baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed messages/sec drop vs the baseline')
+    args = parser.parse_args()
+
+    result = run_benchmark(args)
+    print_report(result)
+
+    if result['processed'] < result['messages'] or result['links_failed']:
+        # A broken run must not pass as fast, nor become a baseline
+        print(f"Failed: {result['messages'] - result['processed']} messages not processed, "
+              f"{result['links_failed']} links failed")
+        sys.exit(1)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        change = result['messages_per_sec'] / baseline['messages_per_sec'] - 1
+        print(f"Baseline:       {baseline['messages_per_sec']:.1f} messages/sec ({change:+.1%})")
+        if change < -args.tolerance:
+            print(f"Regression: throughput dropped more than {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
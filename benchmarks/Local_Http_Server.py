@@ -0,0 +1,106 @@
+"""
+Local stand-in for the Delhivery invoice links, so link downloads can be benchmarked offline.
+GET /delhivery/invoice/<name> returns a deterministic PDF-like body; names ending in .zip
+return a ZIP archive and names starting with "fail" return 503. Responses carry an ETag and
+Last-Modified and honour If-None-Match, If-Modified-Since, Range and If-Range like a CDN would.
+"""
+import hashlib
+import io
+import threading
+import time
+import zipfile
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def invoice_body(name, size):
+    """Deterministic file content for an invoice link, roughly size bytes long"""
+    seed = hashlib.sha256(name.encode()).digest()
+    body = b'%PDF-1.4\n' + seed * (max(size - 9, 0) // len(seed) + 1)
+    return body[:max(size, 9)]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        name = self.path.rstrip('/').split('/')[-1]
+        if not self.path.startswith('/delhivery/invoice/') or name.startswith('fail'):
+            self.send_error(503 if name.startswith('fail') else 404)
+            return
+
+        if name.lower().endswith('.zip'):
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr(name[:-4] + '.pdf', invoice_body(name, self.server.file_size))
+            body, content_type = buffer.getvalue(), 'application/zip'
+        else:
+            body, content_type = invoice_body(name, self.server.file_size), 'application/pdf'
+
+        etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+        last_modified = formatdate(self.server.last_modified, usegmt=True)
+        if self.headers.get('If-None-Match') == etag or (
+                self.headers.get('If-Modified-Since') == last_modified and not self.headers.get('If-None-Match')):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            with self.server.stats_lock:
+                self.server.not_modified += 1
+            return
+
+        status, start = 200, 0
+        requested = self.headers.get('Range', '')
+        if requested.startswith('bytes=') and self.headers.get('If-Range', etag) in (etag, last_modified):
+            start = int(requested[len('bytes='):].split('-')[0])
+            if start < len(body):
+                status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{len(body) - 1}/{len(body)}')
+            body = body[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.stats_lock:
+            self.server.requests += 1
+            self.server.bytes_sent += len(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalHttpServer(ThreadingHTTPServer):
+    """Threaded HTTP server on localhost with a configurable per-request latency"""
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, file_size=20 * 1024, latency=0.0):
+        super().__init__((host, port), _Handler)
+        self.file_size = file_size
+        self.latency = latency  # Seconds slept before each response, to mimic a remote server
+        self.last_modified = time.time()
+        self.requests = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+        self.stats_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def start(self):
+        """Serve from a background thread and return the server"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,483 @@
+"""
+Minimal in-process IMAP4rev1 server for benchmarking MailBox without Gmail.
+Implements the subset MailBox uses: LOGIN, SELECT, STATUS, SEARCH, FETCH (including
+BODYSTRUCTURE, ENVELOPE and BODY.PEEK sections), STORE with UNCHANGEDSINCE, and IDLE.
+Messages live in memory only.
+"""
+import email
+import email.utils
+import re
+import socket
+import socketserver
+import threading
+from email import policy
+
+
+def _q(s):
+    if s is None:
+        return 'NIL'
+    return '"' + str(s).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _split_message(raw):
+    """Return (header_bytes, body_bytes) of a message or part"""
+    for sep in (b'\r\n\r\n', b'\n\n'):
+        idx = raw.find(sep)
+        if idx >= 0:
+            return raw[:idx + len(sep)], raw[idx + len(sep):]
+    return raw, b''
+
+
+class StoredMessage:
+    """A message in a folder with its UID, flags and modification sequence"""
+
+    def __init__(self, uid, raw, flags=()):
+        self.uid = uid
+        self.raw = raw
+        self.flags = set(flags)
+        self.modseq = 1
+        self.message = email.message_from_bytes(raw, policy=policy.compat32)
+
+    def part(self, section):
+        part = self.message
+        for index in section.split('.'):
+            # Parts of a forwarded message are numbered under the message/rfc822 part itself
+            if part is not self.message and part.get_content_type() == 'message/rfc822':
+                part = part.get_payload(0)
+            if part.is_multipart():
+                part = part.get_payload()[int(index) - 1]
+            elif index != '1':
+                raise ValueError(f'no part {section}')
+        return part
+
+    def section_bytes(self, section):
+        section = section.upper()
+        if section == '':
+            return self.raw
+        if section == 'HEADER':
+            return _split_message(self.raw)[0]
+        if section == 'TEXT':
+            return _split_message(self.raw)[1]
+        if section.startswith('HEADER.FIELDS'):
+            names = re.findall(r'[\w-]+', section[len('HEADER.FIELDS'):])
+            out = b''
+            for name in names:
+                for value in self.message.get_all(name) or []:
+                    out += f'{name}: {value}\r\n'.encode()
+            return out + b'\r\n'
+        if section.endswith('.MIME'):
+            part = self.part(section[:-5])
+            return _split_message(part.as_bytes())[0]
+        part = self.part(section)
+        return _split_message(part.as_bytes())[1]
+
+    def bodystructure(self, part=None):
+        part = self.message if part is None else part
+        if part is not self.message and part.get_content_type() == 'message/rfc822':
+            inner = part.get_payload(0)
+            enc = (part.get('Content-Transfer-Encoding') or '7BIT').upper()
+            body = _split_message(part.as_bytes())[1]
+            lines = body.count(b'\n')
+            return (f'("MESSAGE" "RFC822" {self._params(part)} NIL NIL {_q(enc)} {len(body)} '
+                    f'{self.envelope(inner)} {self.bodystructure(inner)} {lines} '
+                    f'NIL {self._disposition(part)} NIL)')
+        if part.is_multipart():
+            children = ''.join(self.bodystructure(p) for p in part.get_payload())
+            return f'({children} {_q(part.get_content_subtype().upper())} {self._params(part)} NIL NIL)'
+        maintype = part.get_content_maintype().upper()
+        enc = (part.get('Content-Transfer-Encoding') or '7BIT').upper()
+        body = _split_message(part.as_bytes())[1]
+        disposition = self._disposition(part)
+        out = (f'({_q(maintype)} {_q(part.get_content_subtype().upper())} {self._params(part)} '
+               f'NIL NIL {_q(enc)} {len(body)}')
+        if maintype == 'TEXT':
+            out += ' ' + str(body.count(b'\n'))
+        return out + f' NIL {disposition} NIL)'
+
+    def envelope(self, message=None):
+        m = self.message if message is None else message
+
+        def addresses(name):
+            values = m.get_all(name)
+            if not values:
+                return 'NIL'
+            out = []
+            for display, addr in email.utils.getaddresses(values):
+                mailbox, _, host = addr.partition('@')
+                out.append(f'({_q(display or None)} NIL {_q(mailbox)} {_q(host)})')
+            return '(' + ''.join(out) + ')'
+        return (f"({_q(m['Date'])} {_q(m['Subject'])} {addresses('From')} {addresses('Sender') if m['Sender'] else addresses('From')} "
+                f"{addresses('Reply-To') if m['Reply-To'] else addresses('From')} {addresses('To')} {addresses('Cc')} "
+                f"{addresses('Bcc')} {_q(m['In-Reply-To'])} {_q(m['Message-ID'])})")
+
+    @staticmethod
+    def _raw_params(value):
+        """Parameters of a header as sent, like real servers report them (RFC 2231 continuations undecoded)"""
+        params = re.findall(r';\s*([^=\s;]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;\s]*)', value or '')
+        if not params:
+            return 'NIL'
+        return '(' + ' '.join(f'{_q(k.upper())} {_q(email.utils.unquote(v))}' for k, v in params) + ')'
+
+    @classmethod
+    def _params(cls, part):
+        return cls._raw_params(part.get('Content-Type'))
+
+    @classmethod
+    def _disposition(cls, part):
+        value = part.get('Content-Disposition')
+        if not value:
+            return 'NIL'
+        return f'({_q(value.split(";")[0].strip().upper())} {cls._raw_params(value)})'
+
+
+class Folder:
+    """In-memory mailbox folder; append() makes new messages visible to IDLE clients"""
+
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.messages = []
+        self.next_uid = 1
+        self.modseq = 1
+        self.changed = threading.Condition()
+
+    def next_modseq(self):
+        self.modseq += 1
+        return self.modseq
+
+    def append(self, raw, flags=()):
+        with self.changed:
+            self.messages.append(StoredMessage(self.next_uid, raw, flags))
+            self.next_uid += 1
+            self.changed.notify_all()
+
+
+def _tokenize(text):
+    """Split IMAP arguments into atoms, quoted strings and nested lists"""
+    tokens, stack = [], []
+    current = tokens
+    i = 0
+    while i < len(text):
+        ch = text[i]
+        if ch == ' ':
+            i += 1
+        elif ch == '(':
+            stack.append(current)
+            current.append([])
+            current = current[-1]
+            i += 1
+        elif ch == ')':
+            current = stack.pop()
+            i += 1
+        elif ch == '"':
+            j, value = i + 1, ''
+            while text[j] != '"':
+                if text[j] == '\\':
+                    j += 1
+                value += text[j]
+                j += 1
+            current.append(value)
+            i = j + 1
+        else:
+            # Section specs such as BODY.PEEK[HEADER.FIELDS (FROM)] may contain spaces and parentheses
+            m = re.match(r'[^\s()\[]+(\[[^\]]*\])?(<[\d.]+>)?', text[i:])
+            current.append(m.group(0))
+            i += len(m.group(0))
+    return tokens
+
+
+def _in_set(value, seqset, maximum):
+    for piece in seqset.split(','):
+        if ':' in piece:
+            lo, hi = piece.split(':')
+            lo = maximum if lo == '*' else int(lo)
+            hi = maximum if hi == '*' else int(hi)
+            if min(lo, hi) <= value <= max(lo, hi):
+                return True
+        elif (maximum if piece == '*' else int(piece)) == value:
+            return True
+    return False
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.buffer = b''
+        self.folder = None
+        self.exists = 0  # Message count last announced to this client
+        self.authenticated = False
+
+    # -- I/O -------------------------------------------------------------
+    def _readline(self, timeout=None):
+        self.request.settimeout(timeout)
+        while b'\r\n' not in self.buffer:
+            try:
+                chunk = self.request.recv(65536)
+            except socket.timeout:
+                return None
+            if not chunk:
+                raise ConnectionError
+            self.buffer += chunk
+        line, self.buffer = self.buffer.split(b'\r\n', 1)
+        return line.decode()
+
+    def _send(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.request.sendall(data)
+
+    # -- dispatch --------------------------------------------------------
+    def handle(self):
+        self._send('* OK local IMAP stand-in ready\r\n')
+        try:
+            while True:
+                line = self._readline()
+                tag, _, rest = line.partition(' ')
+                command, _, args = rest.partition(' ')
+                command = command.upper()
+                use_uid = False
+                if command == 'UID':
+                    use_uid = True
+                    command, _, args = args.partition(' ')
+                    command = command.upper()
+                handler = getattr(self, 'cmd_' + command.lower(), None)
+                if self.folder is not None and command not in ('SELECT', 'EXAMINE', 'IDLE') \
+                        and len(self.folder.messages) != self.exists:
+                    # Like a real server, announce new mail in the response to whatever comes next
+                    self.exists = len(self.folder.messages)
+                    self._send(f'* {self.exists} EXISTS\r\n')
+                if handler is None:
+                    self._send(f'{tag} BAD unknown command {command}\r\n')
+                    continue
+                try:
+                    if handler(tag, args, use_uid) is False:
+                        return
+                except Exception as e:
+                    self._send(f'{tag} BAD {e}\r\n')
+        except (ConnectionError, OSError):
+            return
+
+    def cmd_capability(self, tag, args, use_uid):
+        # Like Gmail, CONDSTORE is only advertised once logged in
+        capabilities = 'IMAP4rev1 IDLE CONDSTORE' if self.authenticated else 'IMAP4rev1 IDLE'
+        self._send(f'* CAPABILITY {capabilities}\r\n{tag} OK CAPABILITY completed\r\n')
+
+    def cmd_noop(self, tag, args, use_uid):
+        self._send(f'{tag} OK NOOP completed\r\n')
+
+    def cmd_login(self, tag, args, use_uid):
+        user, password = _tokenize(args)
+        if self.server.credentials and self.server.credentials != (user, password):
+            self._send(f'{tag} NO [AUTHENTICATIONFAILED] Invalid credentials\r\n')
+        else:
+            self.authenticated = True
+            self._send(f'{tag} OK LOGIN completed\r\n')
+
+    def cmd_logout(self, tag, args, use_uid):
+        self._send(f'* BYE logging out\r\n{tag} OK LOGOUT completed\r\n')
+        return False
+
+    def cmd_close(self, tag, args, use_uid):
+        self.folder = None
+        self._send(f'{tag} OK CLOSE completed\r\n')
+
+    def cmd_select(self, tag, args, use_uid):
+        name = _tokenize(args)[0]
+        folder = self.server.folders.get(name)
+        if folder is None:
+            self._send(f'{tag} NO [NONEXISTENT] Unknown folder\r\n')
+            return
+        self.folder = folder
+        self.exists = len(folder.messages)
+        self._send(f'* {self.exists} EXISTS\r\n* 0 RECENT\r\n'
+                   f'* OK [UIDVALIDITY {folder.uidvalidity}] UIDs valid\r\n'
+                   f'* OK [UIDNEXT {folder.next_uid}] Predicted next UID\r\n'
+                   f'{tag} OK [READ-WRITE] SELECT completed\r\n')
+
+    cmd_examine = cmd_select
+
+    def cmd_status(self, tag, args, use_uid):
+        name = _tokenize(args)[0]
+        folder = self.server.folders[name]
+        self._send(f'* STATUS {name} (MESSAGES {len(folder.messages)} UIDNEXT {folder.next_uid} '
+                   f'UIDVALIDITY {folder.uidvalidity})\r\n{tag} OK STATUS completed\r\n')
+
+    # -- SEARCH ----------------------------------------------------------
+    def cmd_search(self, tag, args, use_uid):
+        tokens = _tokenize(args)
+        if tokens and str(tokens[0]).upper() == 'CHARSET':
+            tokens = tokens[2:]
+        hits = []
+        messages = self.folder.messages
+        for seq, msg in enumerate(messages, 1):
+            if self._matches(list(tokens), seq, msg):
+                hits.append(str(msg.uid if use_uid else seq))
+        self._send(f'* SEARCH {" ".join(hits)}\r\n{tag} OK SEARCH completed\r\n'.replace('SEARCH \r', 'SEARCH\r'))
+
+    def _matches(self, tokens, seq, msg):
+        while tokens:
+            if not self._match_one(tokens, seq, msg):
+                return False
+        return True
+
+    def _match_one(self, tokens, seq, msg):
+        token = tokens.pop(0)
+        if isinstance(token, list):
+            return self._matches(list(token), seq, msg)
+        key = token.upper()
+        messages = self.folder.messages
+        if key == 'ALL':
+            return True
+        if key == 'UID':
+            return _in_set(msg.uid, tokens.pop(0), messages[-1].uid if messages else 0)
+        if key == 'NOT':
+            return not self._match_one(tokens, seq, msg)
+        if key == 'OR':
+            first = self._match_one(tokens, seq, msg)
+            second = self._match_one(tokens, seq, msg)
+            return first or second
+        if key in ('SINCE', 'BEFORE', 'ON'):
+            wanted = email.utils.parsedate_to_datetime(f'{tokens.pop(0).replace("-", " ")} 00:00:00 +0000').date()
+            sent = email.utils.parsedate_to_datetime(msg.message['Date']).date()
+            return {'SINCE': sent >= wanted, 'BEFORE': sent < wanted, 'ON': sent == wanted}[key]
+        if key in ('FROM', 'TO', 'SUBJECT'):
+            return tokens.pop(0).lower() in str(msg.message[key] or '').lower()
+        if key == 'HEADER':
+            name, value = tokens.pop(0), tokens.pop(0)
+            return value.lower() in str(msg.message[name] or '').lower()
+        if key == 'KEYWORD':
+            return tokens.pop(0) in msg.flags
+        if key == 'UNKEYWORD':
+            return tokens.pop(0) not in msg.flags
+        if key in ('SEEN', 'UNSEEN'):
+            return ('\\Seen' in msg.flags) == (key == 'SEEN')
+        if key in ('DELETED', 'UNDELETED'):
+            return ('\\Deleted' in msg.flags) == (key == 'DELETED')
+        # Bare sequence set
+        return _in_set(seq, token, len(messages))
+
+    # -- FETCH / STORE ---------------------------------------------------
+    def _select_messages(self, seqset, use_uid):
+        messages = self.folder.messages
+        if not messages:
+            return []
+        maximum = messages[-1].uid if use_uid else len(messages)
+        return [(seq, msg) for seq, msg in enumerate(messages, 1)
+                if _in_set(msg.uid if use_uid else seq, seqset, maximum)]
+
+    def cmd_fetch(self, tag, args, use_uid):
+        seqset, _, items = args.partition(' ')
+        items = _tokenize(items)
+        if items and isinstance(items[0], list):
+            items = items[0]
+        items = [str(item) for item in items]
+        if use_uid and 'UID' not in [i.upper() for i in items]:
+            items.insert(0, 'UID')
+        for seq, msg in self._select_messages(seqset, use_uid):
+            chunks = [f'* {seq} FETCH (']
+            first = True
+            for item in items:
+                name = item.upper()
+                prefix = '' if first else ' '
+                first = False
+                if name == 'UID':
+                    chunks.append(f'{prefix}UID {msg.uid}')
+                elif name == 'FLAGS':
+                    chunks.append(f'{prefix}FLAGS ({" ".join(sorted(msg.flags))})')
+                elif name == 'MODSEQ':
+                    chunks.append(f'{prefix}MODSEQ ({msg.modseq})')
+                elif name == 'RFC822.SIZE':
+                    chunks.append(f'{prefix}RFC822.SIZE {len(msg.raw)}')
+                elif name == 'BODYSTRUCTURE':
+                    chunks.append(f'{prefix}BODYSTRUCTURE {msg.bodystructure()}')
+                elif name == 'ENVELOPE':
+                    chunks.append(f'{prefix}ENVELOPE {msg.envelope()}')
+                else:
+                    if name == 'RFC822':
+                        label, data = 'RFC822', msg.raw
+                    else:
+                        m = re.match(r'BODY(?:\.PEEK)?\[([^\]]*)\]', item, re.I)
+                        section = m.group(1)
+                        label, data = f'BODY[{section.upper()}]', msg.section_bytes(section)
+                        if not name.startswith('BODY.PEEK'):
+                            msg.flags.add('\\Seen')
+                    chunks.append(f'{prefix}{label} {{{len(data)}}}\r\n'.encode())
+                    chunks.append(data)
+            chunks.append(')\r\n')
+            self._send(b''.join(c.encode() if isinstance(c, str) else c for c in chunks))
+        self._send(f'{tag} OK FETCH completed\r\n')
+
+    def cmd_store(self, tag, args, use_uid):
+        tokens = _tokenize(args)
+        seqset = tokens.pop(0)
+        unchangedsince = None
+        if isinstance(tokens[0], list):
+            unchangedsince = int(tokens.pop(0)[1])
+        action = tokens.pop(0).upper()
+        flags = tokens[0] if isinstance(tokens[0], list) else tokens
+        modified = []
+        with self.folder.changed:
+            for seq, msg in self._select_messages(seqset, use_uid):
+                if unchangedsince is not None and msg.modseq > unchangedsince:
+                    modified.append(str(msg.uid if use_uid else seq))
+                    continue
+                if action.startswith('+'):
+                    msg.flags.update(flags)
+                elif action.startswith('-'):
+                    msg.flags.difference_update(flags)
+                else:
+                    msg.flags = set(flags)
+                msg.modseq = self.folder.next_modseq()
+                if not action.endswith('.SILENT'):
+                    self._send(f'* {seq} FETCH (UID {msg.uid} FLAGS ({" ".join(sorted(msg.flags))}) '
+                               f'MODSEQ ({msg.modseq}))\r\n')
+        if modified:
+            self._send(f'{tag} OK [MODIFIED {",".join(modified)}] Conditional STORE failed\r\n')
+        else:
+            self._send(f'{tag} OK STORE completed\r\n')
+
+    # -- IDLE ------------------------------------------------------------
+    def cmd_idle(self, tag, args, use_uid):
+        folder = self.folder
+        self._send('+ idling\r\n')
+        while True:
+            line = self._readline(timeout=0.05)
+            if line is not None:
+                if line.upper() == 'DONE':
+                    self._send(f'{tag} OK IDLE terminated\r\n')
+                    return
+            if self.server.drop_idle.is_set():
+                self.request.close()
+                return False
+            if len(folder.messages) != self.exists:
+                self.exists = len(folder.messages)
+                self._send(f'* {self.exists} EXISTS\r\n')
+
+
+class LocalImapServer(socketserver.ThreadingTCPServer):
+    """Plain-text IMAP stand-in serving in-memory folders on localhost"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, credentials=None):
+        super().__init__((host, port), _Handler)
+        self.folders = {}
+        self.credentials = credentials
+        self.drop_idle = threading.Event()  # Set to drop clients waiting in IDLE, to exercise reconnects
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def add_folder(self, name, uidvalidity=1):
+        self.folders[name] = Folder(uidvalidity)
+        return self.folders[name]
+
+    def start(self):
+        """Serve from a background thread and return the server"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,97 @@
+"""
+Generator for synthetic carrier mail shaped like the real Automation folder:
+BlueDart mails with CSV/PDF attachments, Delhivery mails with a "Download Invoice" link,
+mails carrying ZIP archives and resends of earlier attachments.
+"""
+import io
+import random
+import zipfile
+from email.message import EmailMessage
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from mailbox import mbox
+
+
+def _csv_rows(rng, rows):
+    lines = ['AWB,Pickup Date,Weight,Amount']
+    for _ in range(rows):
+        lines.append(f"{rng.randrange(10 ** 10, 10 ** 11)},"
+                     f"{rng.randrange(1, 29):02d}-{rng.randrange(1, 13):02d}-2024,"
+                     f"{rng.uniform(0.5, 30):.2f},{rng.uniform(50, 5000):.2f}")
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def _message(index, sender, subject, sent):
+    message = EmailMessage()
+    message['Subject'] = subject
+    message['From'] = sender
+    message['To'] = 'automation@example.com'
+    message['Date'] = format_datetime(sent)
+    message['Message-ID'] = f'<synthetic-{index}@example.com>'
+    return message
+
+
+def generate_messages(bluedart=100, delhivery=100, zips=20, duplicates=20, csv_rows=200,
+                      link_base='http://127.0.0.1:8000', seed=0):
+    """
+    Return the raw bytes of a shuffled synthetic mailbox.
+    Duplicates resend the attachment of an earlier BlueDart mail under the same name.
+    Delhivery links point at link_base, e.g. a running LocalHttpServer.
+    """
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1, 9, 0, tzinfo=timezone.utc)
+    messages, attachments = [], []
+
+    for i in range(bluedart):
+        message = _message(i, 'invoices@bluedart.com', f'BlueDart invoice {i}', start + timedelta(hours=i))
+        message.set_content('Please find the invoice attached.')
+        filename = f'bluedart_{i}.csv'
+        content = _csv_rows(rng, csv_rows)
+        message.add_attachment(content, maintype='text', subtype='csv', filename=filename)
+        attachments.append((filename, content))
+        messages.append(message)
+
+    for i in range(delhivery):
+        index = bluedart + i
+        message = _message(index, 'billing@delhivery.com', f'Delhivery invoice {i}', start + timedelta(hours=index))
+        message.set_content('Your invoice is ready.')
+        # Every fifth link serves a ZIP archive, like the multi-invoice downloads
+        name = f'inv{i}.zip' if i % 5 == 4 else f'inv{i}'
+        message.add_alternative(
+            f'<html><body><table><tr><td bgcolor="#ED2939">'
+            f'<a href="{link_base}/delhivery/invoice/{name}">Download Invoice</a>'
+            f'</td></tr></table></body></html>', subtype='html')
+        messages.append(message)
+
+    for i in range(zips):
+        index = bluedart + delhivery + i
+        message = _message(index, 'invoices@bluedart.com', f'BlueDart bulk invoices {i}', start + timedelta(hours=index))
+        message.set_content('Monthly invoices attached.')
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for member in range(3):
+                archive.writestr(f'bulk_{i}_{member}.csv', _csv_rows(rng, csv_rows))
+        message.add_attachment(buffer.getvalue(), maintype='application', subtype='zip', filename=f'bulk_{i}.zip')
+        messages.append(message)
+
+    for i in range(duplicates if attachments else 0):
+        index = bluedart + delhivery + zips + i
+        filename, content = rng.choice(attachments)
+        message = _message(index, 'invoices@bluedart.com', f'Re: {filename}', start + timedelta(hours=index))
+        message.set_content('Resending the invoice.')
+        message.add_attachment(content, maintype='text', subtype='csv', filename=filename)
+        messages.append(message)
+
+    rng.shuffle(messages)
+    return [message.as_bytes() for message in messages]
+
+
+def write_mbox(path, messages):
+    """Write raw messages to an mbox file, e.g. for MailBox.replay()"""
+    archive = mbox(path)
+    try:
+        for raw in messages:
+            archive.add(raw)
+        archive.flush()
+    finally:
+        archive.close()
@@ -1,6 +1,7 @@
 import tkinter as tk
 from tkinter import ttk, messagebox
 import threading
+import multiprocessing
 import os
 import sys
 import shutil
@@ -625,8 +626,7 @@ class AutomationGUI:
             self.update_status("Downloading attachments from Gmail...", self.theme['primary'])  # Use theme color
             mailbox = MailBox()
             mailbox.process_all_emails()
-            mailbox._save_processed_ids()
-            mailbox._save_downloaded_files()
+            mailbox.save_state()
             
             # Return the downloads directory path
             downloads_dir = os.path.abspath("downloads")
@@ -774,4 +774,6 @@ def main():
     root.mainloop()
 
 if __name__ == "__main__":
+    # Lets the CSV reader's worker processes start from the frozen Windows executable
+    multiprocessing.freeze_support()
     main() 
\ No newline at end of file